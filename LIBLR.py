@@ -24,11 +24,13 @@ from __future__ import unicode_literals, print_function
 import sys
 import os
 import time
-import json
-import copy
 import re
+import ast
+import codecs
+import functools
 import collections
-import pprint
+import weakref
+import hashlib
 
 from enum import Enum, IntEnum
 
@@ -53,9 +55,13 @@ LOG_INFO = lambda *args: print('info:', *args)
 LOG_DEBUG = lambda *args: print('debug:', *args)
 LOG_VERBOSE = lambda *args: print('debug:', *args)
 
+# 调试开关: 关闭时 "if DEBUG:" 里的调试输出连参数都不会求值
+DEBUG = False
+
 # ignore log levels
-LOG_VERBOSE = lambda *args: 0
-LOG_DEBUG = lambda *args: 0
+if not DEBUG:
+    LOG_VERBOSE = lambda *args: 0
+    LOG_DEBUG = lambda *args: 0
 
 
 #----------------------------------------------------------------------
@@ -65,15 +71,31 @@ class GrammarError (Exception):
     pass
 
 
+#----------------------------------------------------------------------
+# epsilon 的各种写法
+#----------------------------------------------------------------------
+_EPSILON_NAMES = frozenset(('', '%empty', '%e', '%epsilon', '\u03b5', '<empty>'))
+
+
 #----------------------------------------------------------------------
 # 符号类：包括终结符和非终结符，term 代表是否为终结符，
 # 空的话用空字符串表示
 #----------------------------------------------------------------------
+@functools.total_ordering
 class Symbol (object):
 
+    __slots__ = ('name', 'term', 'value', 'token', '_h', '_literal', '_epsilon',
+                 '__weakref__')
+
     def __init__ (self, name, terminal = False):
         self.name = name
         self.term = terminal
+        self.value = None
+        self.token = None
+        self._h = hash(name)
+        # 名字决定的属性只算一次
+        self._literal = self.__check_literal(name)
+        self._epsilon = name in _EPSILON_NAMES
 
     # 转为可打印字符串
     def __str__ (self):
@@ -83,7 +105,9 @@ class Symbol (object):
 
     # 根据不同的类型判断是否相等
     def __eq__ (self, symbol):
-        if isinstance(symbol, str):
+        if self is symbol:
+            return True
+        elif isinstance(symbol, str):
             return (self.name == symbol)
         elif symbol is None:
             return (self is None)
@@ -94,19 +118,7 @@ class Symbol (object):
     def __ne__ (self, symbol):
         return (not (self == symbol))
 
-    # >=
-    def __ge__ (self, symbol):
-        return (self.name >= symbol.name)
-
-    # > 
-    def __gt__ (self, symbol):
-        return (self.name > symbol.name)
-
-    # <=
-    def __le__ (self, symbol):
-        return (self.name <= symbol.name)
-
-    # < 
+    # 其余比较由 total_ordering 生成
     def __lt__ (self, symbol):
         return (self.name < symbol.name)
 
@@ -117,53 +129,73 @@ class Symbol (object):
 
     # 求哈希，有这个函数可以将 Symbol 放到容器里当 key
     def __hash__ (self):
-        return hash(self.name)
+        return self._h
 
     # 拷贝
     def __copy__ (self):
         obj = Symbol(self.name, self.term)
-        if hasattr(self, 'value'):
-            obj.value = self.value
-        if hasattr(self, 'token'):
-            obj.token = self.token
+        obj.value = self.value
+        obj.token = self.token
         return obj
 
     # 深度拷贝
     def __deepcopy__ (self):
+        import copy
         obj = Symbol(self.name, self.term)
-        if hasattr(self, 'value'):
-            obj.value = copy.deepcopy(self.value)
-        if hasattr(self, 'token'):
-            obj.token = copy.deepcopy(self.token)
+        obj.value = copy.deepcopy(self.value)
+        obj.token = copy.deepcopy(self.token)
         return obj
 
     # 判断是否是字符串字面量, 被引号包围的字符串为字面量
-    def _is_literal (self):
-        if len(self.name) < 2:
+    @staticmethod
+    def __check_literal (name):
+        if len(name) < 2:
             return False
-        mark = self.name[0]
+        mark = name[0]
         if mark not in ('"', "'"):
             return False
         # "string" or 'string'
-        if self.name[-1] == mark:
+        if name[-1] == mark:
             return True
         return False
 
+    def _is_literal (self):
+        return self._literal
+
     # 判断是否是空/epsilon
     @property
     def is_epsilon (self):
-        if self.term:
-            return False
-        elif self.name == '':
-            return True
-        if self.name in ('%empty', '%e', '%epsilon', '\u03b5', '<empty>'):
-            return True
-        return False
+        return (not self.term) and self._epsilon
 
     # 判断是否是字符串字面量
     @property
     def is_literal (self):
-        return self._is_literal()
+        return self._literal
+
+
+#----------------------------------------------------------------------
+# 符号池：(name, term) -> Symbol，同名同类型的符号只创建一次，
+# 池中的符号不可修改，需要不同的 term 时重新从池里取。
+# 池里只存弱引用，没有文法再用到的符号会被回收，池不会随着
+# 加载过的文法一直增长
+#----------------------------------------------------------------------
+_SYMBOL_POOL = weakref.WeakValueDictionary()
+
+# 字面量的值，用 literal_eval 代替 eval
+def _literal_value (name):
+    try: value = ast.literal_eval(name)
+    except: value = None
+    return value
+
+def _intern_symbol (name, terminal = False):
+    key = (name, terminal)
+    sym = _SYMBOL_POOL.get(key)
+    if sym is None:
+        sym = Symbol(name, terminal)
+        if sym._literal:
+            sym.value = _literal_value(name)
+        _SYMBOL_POOL[key] = sym
+    return sym
 
 
 #----------------------------------------------------------------------
@@ -175,21 +207,14 @@ def load_symbol (source):
         return source
     # load_symbol("$")
     elif isinstance(source, str):
-        sym = Symbol(source)
+        # 只有引号("" or '')，视为非终结符
+        if len(source) == 2 and source[0] == source[1] and source[0] in ('"', "'"):
+            return _intern_symbol('', False)
         # 字符串字面量视为终结符
-        if sym.is_literal:
-            sym.term = True
-            # 只有引号("" or '')，视为非终结符
-            if len(sym.name) == 2 and sym.name[0] == sym.name[1]:
-                sym.term = False
-                sym.name = ''
-            try: sym.value = eval(sym.name)
-            except: pass
-        elif source == '$':
-            sym.term = True
-        elif source == '#':
-            sym.term = True
-        return sym
+        term = (source[:1] in ('"', "'") and len(source) >= 2 and source[-1] == source[0])
+        if source == '$' or source == '#':
+            term = True
+        return _intern_symbol(source, term)
     # load_symbol(("$"))
     # load_symbol(("$", True))
     elif isinstance(source, list) or isinstance(source, tuple):
@@ -209,27 +234,23 @@ def load_symbol (source):
 #----------------------------------------------------------------------
 # 符号矢量：符号列表
 #----------------------------------------------------------------------
+_UNSET = object()
+
 class Vector (object):
 
     def __init__ (self, vector:list):
         # 产生式的右边
         self.m = tuple(self.__load_vector(vector))
-        self.__hash = None
+        # Symbol 的哈希就是名字的哈希，结果和名字元组的哈希一致
+        self.__hash = hash(self.m)
+        # 最左/最右终结符，第一次用到时计算
+        self.__leftmost = _UNSET
+        self.__rightmost = _UNSET
 
     def __load_vector (self, vector):
-        epsilon = True
-        output = []
+        # 从符号列表中删除所有 epsilon，全是 epsilon 时得到空列表
         p = [ load_symbol(n) for n in vector ]
-        # 从符号列表中删除最左边的 epsilon
-        for symbol in p:
-            if not symbol.is_epsilon:
-                epsilon = False
-                break
-        if not epsilon:
-            for n in p:
-                if not n.is_epsilon:
-                    output.append(n)
-        return output
+        return [ n for n in p if not n.is_epsilon ]
 
     def __len__ (self):
         return len(self.m)
@@ -246,9 +267,6 @@ class Vector (object):
         return False
 
     def __hash__ (self):
-        if self.__hash is None:
-            h = tuple([n.name for n in self.m])
-            self.__hash = hash(h)
         return self.__hash
 
     def __iter__ (self):
@@ -262,9 +280,14 @@ class Vector (object):
         return ' '.join(body)
 
     def __eq__ (self, p):
+        if self is p:
+            return True
         assert isinstance(p, Vector)
-        if hash(self) != hash(p):
+        if self.__hash != p.__hash:
+            return False
+        elif len(self.m) != len(p.m):
             return False
+        # 元组比较对同一个对象不会调用 Symbol.__eq__，符号池让这成为常态
         return (self.m == p.m)
 
     def __ne__ (self, p):
@@ -304,20 +327,28 @@ class Vector (object):
 
     # 计算最左边的终结符
     def leftmost_terminal (self):
+        if self.__leftmost is not _UNSET:
+            return self.__leftmost
+        self.__leftmost = None
         for n in self.m:
             if n.term:
-                return n
-        return None
+                self.__leftmost = n
+                break
+        return self.__leftmost
 
     # 计算最右边的终结符
     def rightmost_terminal (self):
+        if self.__rightmost is not _UNSET:
+            return self.__rightmost
+        self.__rightmost = None
         index = len(self.m) - 1
         while index >= 0:
             symbol = self.m[index]
             if symbol.term:
-                return symbol
+                self.__rightmost = symbol
+                break
             index -= 1
-        return None
+        return self.__rightmost
 
 
 #----------------------------------------------------------------------
@@ -330,15 +361,19 @@ class Production (object):
     def __init__ (self, head, body:list, index = -1):
         self.head = load_symbol(head)
         self.body = Vector(body)
-        self.__hash = None
+        self.__hash = hash((hash(self.head), hash(self.body)))
         self.index = index
         self.is_epsilon = None
         self.has_epsilon = None
         # 优先级
         self.precedence = None
         # 语义动作
-        self.action: dict[int, tuple[str, int]] = None  # {token pos: (token value, token pos)}
-        # such as: {1: [('{get}', 1)]}
+        self.action: list[list[tuple[str, int]]] = None  # [token pos] -> [(token value, token pos)]
+        # such as: [None, [('{get}', 1)]], length is len(body) + 1
+        # RulePtr 享元表: (index, lookahead) -> RulePtr, 见 RulePtr.intern
+        self._items = {}
+        # 排序用的键, 和 __ge__/__gt__ 一致: 左部名字, 右部符号名
+        self._order = (self.head.name, tuple([n.name for n in self.body]))
 
     def __len__ (self):
         return len(self.body)
@@ -349,13 +384,8 @@ class Production (object):
     def __contains__ (self, key):
         return (key in self.body)
 
+    # self.head 和 self.body 的哈希在构造时就合并好了
     def __hash__ (self):
-        if self.__hash is None:
-            # self.head 和 self.body 是对象，先将对象转化成哈希值，再放入到 tuple 容器
-            # self.head 和 self.body 指向的对象必须含有 __hash__ 方法
-            h1 = hash(self.head)
-            h2 = hash(self.body)
-            self.__hash = hash((h1, h2))
         return self.__hash
 
     def __iter__ (self):
@@ -370,6 +400,8 @@ class Production (object):
 
     # 利用对象的哈希值进行比较
     def __eq__ (self, p):
+        if self is p:
+            return True
         assert isinstance(p, Production)
         if hash(self) != hash(p):
             return False
@@ -419,6 +451,7 @@ class Production (object):
         obj.has_epsilon = self.has_epsilon
         obj.__hash = self.__hash
         if self.action:
+            import copy
             obj.action = copy.deepcopy(self.action)
         return obj
 
@@ -467,15 +500,22 @@ class Production (object):
         text = ''
         if head:
             text += str(self.head) + ': '
-        act = getattr(self, 'action', {})
+        # 不需要动作时直接拼接
+        if not action:
+            if body:
+                text += ''.join([n.name + ' ' for n in self.body])
+            if prec:
+                text += ' <%s>'%(self.precedence, )
+            return text.strip('\r\n\t ')
+        act = self.action
         if body:
             for i, n in enumerate(self.body):
-                if action and act and (i in act):
+                if act and act[i]:
                     for m in act[i]:
                         text += '%s '%self.__action_to_string(m)
                 text += n.name + ' '
             i = len(self.body)
-            if action and act and (i in act):
+            if act and act[i]:
                 for m in act[i]:
                     text += '%s '%self.__action_to_string(m)
         if prec:
@@ -531,6 +571,13 @@ class Grammar (object):
         self.assoc = {}             # str -> one of (None, 'left', 'right')
         self._anchor = {}           # str -> (filename, linenum)
         self._dirty = False         # be modified if True
+        self._prod_index = None     # Production -> first index, built lazily
+        self._indexed = None        # snapshot of the last update, None to rebuild
+        self._appended = []         # productions appended since last update
+        self.sym_table = None       # id -> Symbol, see compile_soa()
+        self.sym_id = None          # symbol name str -> id
+        self.body_ids = None        # production index -> tuple of symbol ids
+        self.term_mask = None       # bytes, term_mask[id] == 1 for terminals
         self.scanner = []           # scanner rules
         self.start = None           # Symbol | None
 
@@ -542,6 +589,8 @@ class Grammar (object):
         self.rule.clear()
         self._anchor.clear()
         self.scanner.clear()
+        self._prod_index = None
+        self._indexed = None
         self.start = None
         return 0
 
@@ -565,10 +614,8 @@ class Grammar (object):
         if isinstance(key, int):
             return (key >= 0 and key < len(self.production))
         elif isinstance(key, Production):
-            for p in self.production:
-                # 利用对象的哈希值进行比较
-                if p == key:
-                    return True
+            # 利用对象的哈希值进行比较
+            return (key in self.__production_table())
         elif isinstance(key, Symbol):
             return (key.name in self.symbol)
         elif isinstance(key, str):
@@ -605,11 +652,37 @@ class Grammar (object):
             obj.start = obj.symbol[self.start.name]
         return obj
 
+    # 产生式表：相同 head/body 的产生式映射到第一次出现的下标
+    def __production_table (self):
+        table = self._prod_index
+        # 直接改了 self.production 列表的话，数量对不上就重建
+        if table is None or self._prod_list is not self.production or \
+                self._prod_size != len(self.production):
+            table = {}
+            for i, p in enumerate(self.production):
+                table.setdefault(p, i)
+            self._prod_index = table
+            self._prod_list = self.production
+            self._prod_size = len(self.production)
+        return table
+
+    def __touch (self):
+        self._dirty = True      # be modified
+        self._prod_index = None
+        self._indexed = None    # 下标变了，update 时整体重建 rule
+        return 0
+
     def insert (self, index, production):
         self.production.insert(index, production)
-        self._dirty = True      # be modified
+        self.__touch()
 
     def search (self, p, stop = -1):
+        if isinstance(p, Production):
+            index = self.__production_table().get(p)
+            if index is None:
+                raise ValueError('%r is not in grammar'%(p,))
+            elif index >= stop:
+                return index
         if stop < 0:
             return self.production.index(p)
         return self.production.index(p, stop)
@@ -620,17 +693,26 @@ class Grammar (object):
         else:
             index = self.search(index)
             self.production.pop(index)
-        self._dirty = True
+        self.__touch()
 
     def pop (self, index = -1):
         self.production.pop(index)
-        self._dirty = True
+        self.__touch()
 
     def append (self, production):
         index = len(self.production)
         self.production.append(production)
         production.index = index
         self._dirty = True
+        # 只是追加的话 update 时只登记新的产生式，不用全量重建
+        self._appended.append(production)
+        table = self._prod_index
+        if table is not None:
+            if self._prod_size == index and self._prod_list is self.production:
+                table.setdefault(production, index)
+                self._prod_size += 1
+            else:
+                self._prod_index = None
 
     def replace (self, index, source):
         if isinstance(source, Production):
@@ -641,51 +723,116 @@ class Grammar (object):
                 assert isinstance(n, Production)
                 self.production.insert(index + 1, n)
             self.production.pop(index)
-        self._dirty = True
+        self.__touch()
+
+    # 登记一条产生式的符号和规则
+    # 已经有占位的空规则时返回 False，整体重建才能保持 rule 的顺序：
+    # 先是所有产生式的 head，再是没有产生式的非终结符
+    def __register (self, p, holders = False):
+        head = p.head
+        symbol = self.symbol
+        rule = self.rule.get(head.name)
+        if holders and not rule:
+            return False
+        if head.name not in symbol:
+            symbol[head.name] = head
+        for n in p.body:
+            # n: symbol
+            if n.name not in symbol:
+                symbol[n.name] = n
+        if rule is None:
+            self.rule[head.name] = [p]
+        else:
+            rule.append(p)
+        return True
+
+    # 对齐产生式里符号的 term 标志
+    # 符号是共享的，term 不对时换成池里正确的那个，而不是修改它
+    def __align (self, p):
+        terminal = self.terminal
+        head = p.head
+        if head.term != (head.name in terminal):
+            p.head = _intern_symbol(head.name, not head.term)
+        for n in p.body:
+            if n.term != (n.name in terminal):
+                body = [_intern_symbol(n.name, n.name in terminal) for n in p.body]
+                p.body = Vector(body)
+                # 项目里缓存了圆点后的符号，换了符号就丢掉旧的享元项目
+                p._items.clear()
+                break
+        if p.precedence is None:
+            rightmost = p.rightmost_terminal()
+            if rightmost and (rightmost in self.precedence):
+                p.precedence = rightmost.name
+        return 0
 
     def update (self):
-        self.symbol.clear()
-        self.rule.clear()
-        for i, p in enumerate(self.production):
-            # p: production
-            p.index = i
-            head = p.head
-            if head.name not in self.symbol:
-                self.symbol[head.name] = head
-            for n in p.body:
-                # n: symbol
-                if n.name not in self.symbol:
-                    self.symbol[n.name] = n
-            self.rule.setdefault(head.name, []).append(p)
-        for n in self.terminal:
-            s = self.terminal[n]
-            if not s.term:
-                s.term = True
+        self._prod_index = None
+        terminal = self.terminal
+        production = self.production
+        appended = self._appended
+        # 快照: 产生式对象的 id、终结符和优先级。上次 update 之后只通过
+        # append() 追加过产生式时，production 列表是上次登记过的那些对象
+        # 再加上追加的，只登记追加的部分就行；插入、删除、替换、直接改过
+        # production 列表，或者终结符、优先级变了，都要全量重建
+        ids = [id(p) for p in production]
+        snapshot = (ids, list(terminal), list(self.precedence.items()))
+        indexed = self._indexed
+        fast = (indexed is not None) and (indexed[1:] == snapshot[1:]) and \
+                (ids == indexed[0] + [id(p) for p in appended])
+        if fast:
+            holders = any(not rules for rules in self.rule.values())
+            for p in appended:
+                self.__align(p)
+                if not self.__register(p, holders):
+                    fast = False
+                    break
+        if not fast:
+            for n in terminal:
+                if not terminal[n].term:
+                    terminal[n] = _intern_symbol(n, True)
+            self.symbol.clear()
+            self.rule.clear()
+            for i, p in enumerate(production):
+                # p: production
+                p.index = i
+                self.__align(p)
+                self.__register(p)
         for n in self.symbol:
             s = self.symbol[n]
-            s.term = (n in self.terminal)
+            if s.term != (n in terminal):
+                s = self.symbol[n] = _intern_symbol(n, not s.term)
             if not s.term:
                 if s.name not in self.rule:
                     self.rule[s.name] = []
-        for p in self.production:
-            p.head.term = (p.head.name in self.terminal)
-            for n in p.body:
-                n.term = (n.name in self.terminal)
-        for p in self.production:
-            if p.precedence is None:
-                rightmost = p.rightmost_terminal()
-                if rightmost and (rightmost in self.precedence):
-                    p.precedence = rightmost.name
+        self._indexed = snapshot
+        appended.clear()
+        self.sym_table = None
         self._dirty = False
         return 0
 
+    # 把符号编号，产生式右边转成整数 id 的序列 (struct of arrays)，
+    # 需要时调用，update() 之后失效
+    def compile_soa (self):
+        if self._dirty:
+            self.update()
+        if self.sym_table is not None:
+            return 0
+        sym_table = list(self.symbol.values())
+        sym_id = {}
+        for i, sym in enumerate(sym_table):
+            sym_id[sym.name] = i
+        self.body_ids = [tuple([sym_id[n.name] for n in p.body]) for p in self.production]
+        self.term_mask = bytes([(sym.term and 1 or 0) for sym in sym_table])
+        self.sym_id = sym_id
+        self.sym_table = sym_table
+        return 0
+
     # declare terminal
     def push_token (self, token):
         name = self._symbol_name(token)
         if token not in self.terminal:
-            t = load_symbol(token)
-            t.term = True
-            self.terminal[name] = t
+            self.terminal[name] = _intern_symbol(name, True)
         self._dirty = True
         return 0
 
@@ -706,8 +853,8 @@ class Grammar (object):
     def create_symbol (self, name):
         cc = load_symbol(name)
         if name != '':
-            if name in self.terminal:
-                cc.term = True
+            if name in self.terminal and not cc.term:
+                cc = _intern_symbol(cc.name, True)
         return cc
 
     # 新增产生式 S' -> S, 构成增广文法(augmented grammar)
@@ -724,6 +871,20 @@ class Grammar (object):
         self.update()
         return 0
 
+    # 文法指纹: 产生式、语义动作位置、终结符和优先级都相同的文法,
+    # 生成的分析表也相同, 用来判断缓存在磁盘上的分析表是否还能用
+    def fingerprint (self) -> str:
+        items = []
+        for p in self.production:
+            body = tuple([n.name for n in p.body])
+            items.append((p.head.name, body, p.precedence, p.action))
+        items.append(sorted(self.terminal.keys()))
+        items.append(sorted(self.precedence.items()))
+        items.append(sorted(self.assoc.items()))
+        items.append(self.start and self.start.name)
+        text = repr(items)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
     def __anchor_key (self, obj):
         if isinstance(obj, str):
             return obj
@@ -732,9 +893,16 @@ class Grammar (object):
         elif isinstance(obj, int):
             return '^INT/' + str(obj)
         elif isinstance(obj, Vector):
-            return '^VEC/' + str(obj)
+            key = obj.__dict__.get('_anchor_key')
+            if key is None:
+                key = obj._anchor_key = '^VEC/' + str(obj)
+            return key
         elif isinstance(obj, Production):
-            return '^PROD/' + str(obj)
+            # 字符串只和符号名字有关，算一次存在对象上
+            key = obj.__dict__.get('_anchor_key')
+            if key is None:
+                key = obj._anchor_key = '^PROD/' + str(obj)
+            return key
         return str(obj)
 
     # use to print symbol message
@@ -823,52 +991,66 @@ class Token (object):
 #----------------------------------------------------------------------
 # tokenize
 #----------------------------------------------------------------------
-def _tokenize(code, specs, eof = None):
+#----------------------------------------------------------------------
+# 合并后的正则按模式列表缓存，同一套规则只编译一次
+#----------------------------------------------------------------------
+@functools.lru_cache(maxsize = 256)
+def _compile_specs(patterns):
+    tok_regex = '|'.join('(?P<PATTERN%d>%s)'%(i, p) for i, p in enumerate(patterns))
+    return re.compile(tok_regex)
+
+# 行号增量维护: 只统计上一个位置 last 到 pos 之间的换行, 返回
+# pos 所在的 (行号, 行首位置), 行号从 0 开始
+def _advance_line(code, line_num, line_start, last, pos):
+    nl = code.count('\n', last, pos)
+    if nl:
+        return line_num + nl, code.rfind('\n', last, pos) + 1
+    return line_num, line_start
+
+def _tokenize(code, specs, eof = None, regex = None):
     patterns = []
-    definition = {}
-    extended = {}
     if not specs:
         return None
-    for index in range(len(specs)):
-        spec = specs[index]
-        name, pattern = spec[:2]
-        # pn: pattern name
-        pn = 'PATTERN%d'%index
-        definition[pn] = name       # pattern name -> call | None | token name
+    # 规则拆成平行数组，用规则序号直接索引
+    definition = []     # index -> call | None | token name
+    extended = []       # index -> extra argument | _UNSET
+    for spec in specs:
+        definition.append(spec[0])
         if len(spec) >= 3:
-            extended[pn] = spec[2]
-        patterns.append((pn, pattern))
-    tok_regex = '|'.join('(?P<%s>%s)' % pair for pair in patterns)
-    # print(tok_regex)
-    # 每行的起始位置, 索引号代表行号
-    line_starts = []
-    pos = 0
-    index = 0
-    while 1:
-        line_starts.append(pos)
-        pos = code.find('\n', pos)
-        if pos < 0:
-            break
-        pos += 1
+            extended.append(spec[2])
+        else:
+            extended.append(_UNSET)
+        patterns.append(spec[1])
+    # regex: 调用方预先编译好的合并正则
+    tok_regex = regex
+    if tok_regex is None:
+        tok_regex = _compile_specs(tuple(patterns))
+    # 分组编号 -> 规则序号 (规则里面可能还有自己的分组)
+    slots = [0] * (tok_regex.groups + 1)
+    for pn, group in tok_regex.groupindex.items():
+        if pn.startswith('PATTERN'):
+            slots[group] = int(pn[7:])
     line_num = 0
-    for mo in re.finditer(tok_regex, code):
-        # group variable name: PATTERN0, PATTERN1 ...
-        kind = mo.lastgroup
+    line_start = 0
+    last_pos = 0
+    for mo in tok_regex.finditer(code):
+        # 最后结束的分组就是最外层的 PATTERN0, PATTERN1 ...
+        kind = slots[mo.lastindex]
         value = mo.group()
         start = mo.start()
-        while line_num < len(line_starts) - 1:
-            if line_starts[line_num + 1] > start:
-                break
-            line_num += 1
-        line_start = line_starts[line_num]
+        if start != last_pos:
+            line_num, line_start = _advance_line(code, line_num, line_start,
+                                                 last_pos, start)
+            last_pos = start
         name = definition[kind]
         if name is None:
             continue
         if callable(name):
-            if kind not in extended:
+            extra = extended[kind]
+            if extra is _UNSET:
                 obj = name(value)
             else:
-                obj = name(value, extended[kind])
+                obj = name(value, extra)
             name = None
             if isinstance(obj, list) or isinstance(obj, tuple):
                 if len(obj) > 0: 
@@ -881,17 +1063,18 @@ def _tokenize(code, specs, eof = None):
         # (<token name>, <token value>, <line number>, <column>)
         yield (name, value, line_num + 1, start - line_start + 1)
     if eof is not None:
-        line_start = line_starts[-1]
         endpos = len(code)
-        yield (eof, '', len(line_starts), endpos - line_start + 1)
+        line_num, line_start = _advance_line(code, line_num, line_start,
+                                             last_pos, endpos)
+        yield (eof, '', line_num + 1, endpos - line_start + 1)
     return 0
 
 
 #----------------------------------------------------------------------
 # Tokenize
 #----------------------------------------------------------------------
-def tokenize(code, rules, eof = None):
-    for info in _tokenize(code, rules, eof):
+def tokenize(code, rules, eof = None, regex = None):
+    for info in _tokenize(code, rules, eof, regex):
         yield Token(info[0], info[1], info[2], info[3])
     return 0
 
@@ -899,9 +1082,13 @@ def tokenize(code, rules, eof = None):
 #----------------------------------------------------------------------
 # validate pattern
 #----------------------------------------------------------------------
+@functools.lru_cache(maxsize = 512)
+def _regex_compile(pattern):
+    return re.compile(pattern)
+
 def validate_pattern(pattern):
     try:
-        re.compile(pattern)
+        _regex_compile(pattern)
     except re.error:
         return False
     return True
@@ -910,45 +1097,35 @@ def validate_pattern(pattern):
 #----------------------------------------------------------------------
 # replace '{name}' in a pattern with the text in "macros[name]"
 #----------------------------------------------------------------------
+_MACRO_RE = re.compile(r'\\.|\{([^}]*)\}', re.DOTALL)
+
 def regex_expand(macros, pattern, guarded = True):
-    output = []
-    pos = 0
-    size = len(pattern)
-    while pos < size:
-        ch = pattern[pos]
-        if ch == '\\':
-            output.append(pattern[pos:pos + 2])
-            pos += 2
-            continue
-        elif ch != '{':
-            output.append(ch)
-            pos += 1
-            continue
-        p2 = pattern.find('}', pos)
-        if p2 < 0:
-            output.append(ch)
-            pos += 1
-            continue
-        p3 = p2 + 1
-        name = pattern[pos + 1:p2].strip('\r\n\t ')
+    # 同一个宏多次引用时直接复用替换结果
+    resolved = {}
+    def replace(m):
+        name = m.group(1)
+        # 转义字符原样保留
+        if name is None:
+            return m.group(0)
+        text = resolved.get(name)
+        if text is None:
+            text = expand(name, m.group(0))
+            resolved[name] = text
+        return text
+    def expand(name, origin):
+        name = name.strip('\r\n\t ')
         if name == '':
-            output.append(pattern[pos:p3])
-            pos = p3
-            continue
+            return origin
         if name[0].isdigit():
-            output.append(pattern[pos:p3])
-            pos = p3
-            continue
+            return origin
         if ('<' in name) or ('>' in name):
             raise ValueError('invalid pattern name "%s"'%name)
         if name not in macros:
             raise ValueError('{%s} is undefined'%name)
         if guarded:
-            output.append('(?:' + macros[name] + ')')
-        else:
-            output.append(macros[name])
-        pos = p3
-    return ''.join(output)
+            return '(?:' + macros[name] + ')'
+        return macros[name]
+    return _MACRO_RE.sub(replace, pattern)
 
 
 #----------------------------------------------------------------------
@@ -981,7 +1158,7 @@ def regex_build(code, macros = None, capture = True):
         except ValueError as e:
             raise ValueError('%d: %s'%(line_num, str(e)))
         try:
-            re.compile(pattern)
+            _regex_compile(pattern)
         except re.error:
             raise ValueError('%d: invalid pattern "%s"'%(line_num, pattern))
         if not capture:
@@ -998,6 +1175,8 @@ PATTERN_WHITESPACE = r'[ \t\r\n]+'
 PATTERN_COMMENT1 = r'[#].*'
 PATTERN_COMMENT2 = r'\/\/.*'
 PATTERN_COMMENT3 = r'\/\*([^*]|[\r\n]|(\*+([^*/]|[\r\n])))*\*+\/'
+# 三种注释合成一条，共用开头的 '/'
+PATTERN_COMMENT = r'[#].*|\/(?:\/.*|\*(?:[^*]|[\r\n]|(?:\*+(?:[^*/]|[\r\n])))*\*+\/)'
 PATTERN_MISMATCH = r'.'
 PATTERN_NAME = r'\w+'
 PATTERN_GNAME = r'\w(?:\w|\@)*[\']*'
@@ -1145,10 +1324,13 @@ class internal (object):
 
     @staticmethod
     def bfs(initial, expand):
-        open_list = collections.deque(list(initial))
+        # 用列表加游标代替 deque.popleft，访问顺序不变
+        open_list = list(initial)
         visited = set(open_list)
-        while open_list:
-            node = open_list.popleft()
+        index = 0
+        while index < len(open_list):
+            node = open_list[index]
+            index += 1
             yield node
             for child in expand(node):
                 if child not in visited:
@@ -1156,23 +1338,82 @@ class internal (object):
                     visited.add(child)
         return 0
 
+    # Tarjan 强连通分量 (非递归版本)，按逆拓扑序返回:
+    # 一个分量能到达的分量都排在它前面
+    @staticmethod
+    def scc(nodes, expand):
+        index = {}
+        lowlink = {}
+        stack = []
+        onstack = set()
+        output = []
+        for root in nodes:
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            onstack.add(root)
+            work = [(root, iter(expand(root)))]
+            while work:
+                node, children = work[-1]
+                advanced = False
+                for child in children:
+                    if child not in index:
+                        index[child] = lowlink[child] = len(index)
+                        stack.append(child)
+                        onstack.add(child)
+                        work.append((child, iter(expand(child))))
+                        advanced = True
+                        break
+                    elif child in onstack:
+                        lowlink[node] = min(lowlink[node], index[child])
+                if advanced:
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while 1:
+                        n = stack.pop()
+                        onstack.discard(n)
+                        component.append(n)
+                        if n == node:
+                            break
+                    output.append(component)
+        return output
+
 
 #----------------------------------------------------------------------
 # cstring lib
 #----------------------------------------------------------------------
+_UNQUOTE_RE = re.compile(r'\\(u.{0,4}|x.{0,2}|.)', re.DOTALL)
+_UNQUOTE_MAP = {'n': '\n', 't': '\t', '"': '"', "'": "\\'", 'r': '\r', '\\': '\\'}
+_QUOTE_TABLE = dict([(i, '\\x%02x'%i) for i in range(32)])
+_QUOTE_TABLE[ord("'")] = "\\'"
+_UNICODE_RE = re.compile('[\u0080-\U0010ffff]')
+_BOOL_TRUE = frozenset(('true', '1', 'yes', 't', 'enable'))
+_BOOL_FALSE = frozenset(('0', 'false', 'no', 'n', 'f', 'disable'))
+_INT_PREFIX = {'0x': 16, '0b': 2}
+
+def _quote_unicode(m):
+    cc = ord(m.group(0))
+    if cc >= 256:
+        return '\\u%04x'%cc
+    return '\\x%02x'%cc
+
 class cstring (object):
 
     @staticmethod
     def string_to_int(text, round = 0):
         text = text.strip('\r\n\t ').lstrip('+')
         minus = False
-        if text.startswith('-'):
+        if text[:1] == '-':
             minus = True
             text = text.lstrip('-')
-        if text.startswith('0x'):
-            round = 16
-        elif text.startswith('0b'):
-            round = 2
+        # 只看前两个字符决定进制
+        round = _INT_PREFIX.get(text[:2], round)
         text = text.rstrip('uUlLbB')
         try:
             # 进制转化
@@ -1191,9 +1432,10 @@ class cstring (object):
         text = text.strip('\r\n\t ')
         if text == '':
             return defval
-        if text.lower() in ('true', '1', 'yes', 't', 'enable'):
+        lower = text.lower()
+        if lower in _BOOL_TRUE:
             return True
-        if text.lower() in ('0', 'false', 'no', 'n', 'f', 'disable'):
+        if lower in _BOOL_FALSE:
             return False
         x = cstring.string_to_int(text)
         if text.isdigit() or x != 0:
@@ -1224,63 +1466,36 @@ class cstring (object):
             return text.replace('"', '').replace("'", '')
         if text[-1] != mark:
             return text.replace('"', '').replace("'", '')
-        # 最左右存在引号
-        pos = 1
-        output = []
-        size = len(text)
-        m = {'\\n': '\n', '\\t': '\t', '\\"': '"',
-             "\\'": "\\'", '\\r': '\r', '\\\\': '\\',
-             }
-        while pos < size - 1:
-            ch = text[pos]
-            if ch == '\\':
-                nc = text[pos:pos + 2]
-                pos += 2
-                if nc == '\\u':
-                    u = text[pos:pos + 4]
-                    pos += 4
-                    try:
-                        x = int('0x' + u, 16)
-                    except:
-                        x = ord('?')
-                    output.append(chr(x))
-                elif nc == '\\x':
-                    u = text[pos:pos + 2]
-                    pos += 2
-                    try:
-                        x = int('0x' + u, 16)
-                    except:
-                        x = ord('?')
-                    output.append(chr(x))
-                elif nc in m:
-                    output.append(m[nc])
-                else:
-                    output.append(nc)
-            else:
-                output.append(ch)
-                pos += 1
-        return ''.join(output)
+        # 最左右存在引号，只在转义的地方回调，其余部分由正则引擎直接拷贝
+        body = text[1:]
+        last = [0]
+        def replace(m):
+            last[0] = m.end()
+            nc = m.group(1)
+            if nc[0] == 'u' or nc[0] == 'x':
+                try:
+                    x = int('0x' + nc[1:], 16)
+                except:
+                    x = ord('?')
+                return chr(x)
+            return _UNQUOTE_MAP.get(nc, '\\' + nc)
+        text = _UNQUOTE_RE.sub(replace, body)
+        # 结尾的引号没有被转义吃掉的话去掉它
+        if last[0] < len(body):
+            text = text[:-1]
+        return text
 
     @staticmethod
     def string_quote(text, escape_unicode = False):
-        output = []
-        output.append("'")
-        for ch in text:
-            cc = ord(ch)
-            if ch == "'":
-                output.append("\\'")
-            elif (cc >= 256 and escape_unicode):
-                nc = hex(ord(ch))[2:]
-                nc = nc.rjust(4, '0')
-                output.append('\\u' + nc)
-            elif (cc >= 128 and escape_unicode) or cc < 32:
-                nc = hex(cc)[2:]
-                nc = nc.rjust(2, '0')
-                output.append('\\x' + nc)
-            else:
-                output.append(ch)
-        output.append("'")
-        return ''.join(output)
+        # 常见情况: 没有需要转义的字符，直接加引号
+        if "'" not in text and text.isprintable():
+            if not escape_unicode or text.isascii():
+                return "'" + text + "'"
+        # 控制字符和单引号查表替换
+        text = text.translate(_QUOTE_TABLE)
+        if escape_unicode:
+            text = _UNICODE_RE.sub(_quote_unicode, text)
+        return "'" + text + "'"
 
     @staticmethod
     def quoted_normalize(text, double = False):
@@ -1367,6 +1582,9 @@ class cstring (object):
             text = content[3:].decode('utf-8')
         elif encoding is not None:
             text = content.decode(encoding, 'ignore')
+        elif content.isascii():
+            # 纯 ASCII 文件任何编码结果都一样，不用逐个猜
+            text = content.decode('ascii')
         else:
             text = None
             guess = [sys.getdefaultencoding(), 'utf-8']
@@ -1378,11 +1596,16 @@ class cstring (object):
             except:
                 pass
             visit = {}
+            # 先用开头 4KB 试探，失败的编码不用再解码整个文件
+            head = content[:4096]
             for name in guess + ['gbk', 'ascii', 'latin1']:
                 if name in visit:
                     continue
                 visit[name] = 1
                 try:
+                    if len(head) < len(content):
+                        # final=False: 截断处不完整的多字节字符不算错误
+                        codecs.getincrementaldecoder(name)().decode(head, False)
                     text = content.decode(name)
                     break
                 except:
@@ -1398,10 +1621,11 @@ class cstring (object):
         output = []
         if not rows:
             return ''
+        # 每个单元格只转换一次字符串
+        rows = [[str(text) for text in row] for row in rows]
         for row in rows:
             maxcol = max(len(row), maxcol)
             for col, text in enumerate(row):
-                text = str(text)
                 size = len(text)
                 if col not in colsize:
                     colsize[col] = size
@@ -1409,6 +1633,8 @@ class cstring (object):
                     colsize[col] = max(size, colsize[col])
         if maxcol <= 0:
             return ''
+        # align default to left
+        spec = {'right': '>', 'center': '^'}.get(align, '<')
         def gettext(row, col):
             # cell 的长度为 2 + cszie, 左右边距为 1
             csize = colsize[col]
@@ -1417,18 +1643,7 @@ class cstring (object):
             row = rows[row]
             if col >= len(row):
                 return ' ' * (csize + 2)
-            text = str(row[col])
-            padding = (2 + csize) - len(text)
-            # align default to left
-            pad1 = 1
-            pad2 = padding - pad1
-            if align == "right":
-                pad2 = 1
-                pad1 = padding - pad2
-            elif align == "center":
-                pad1 = int(padding / 2) # padding 至少为 2
-                pad2 = padding - pad1
-            return (' ' * pad1) + text + (' ' * pad2)
+            return ' ' + format(row[col], spec + str(csize)) + ' '
         if style == 0:
             for y, row in enumerate(rows):
                 line = ''.join([ gettext(y, x) for x in range(maxcol) ])
@@ -1468,10 +1683,39 @@ class cstring (object):
 #----------------------------------------------------------------------
 # lex analyze
 #----------------------------------------------------------------------
+
+# 词法回调为模块级函数，匹配时不用再经过绑定方法
+# 符号名字符串驻留，之后的哈希和比较都更快
+def _handle_string (value):
+    text = cstring.quoted_normalize(value)
+    if text is not None:
+        text = sys.intern(text)
+    return ('STRING', text)
+
+def _handle_name (value):
+    return ('NAME', sys.intern(value))
+
+def _handle_integer (value):
+    return ('NUMBER', cstring.string_to_int(value))
+
+def _handle_float (value):
+    if '.' not in value:
+        return _handle_integer(value)
+    return ('NUMBER', cstring.string_to_float(value))
+
+# 匹配规则保证 MACRO/ACTION 两端没有空白，不用再 strip
+def _handle_macro (value):
+    return ('MACRO', value.replace(' ', ''))
+
+def _handle_action (value):
+    return ('ACTION', value)
+
 class GrammarLex (object):
 
     def __init__ (self):
         self.specific = self._build_pattern()
+        # 合并后的正则只编译一次，规则相同的实例共享同一个对象
+        self.regex = _compile_specs(tuple([n[1] for n in self.specific]))
 
     def _build_pattern (self):
         spec = [
@@ -1479,62 +1723,48 @@ class GrammarLex (object):
                     # (回调函数|None|Token Name，匹配规则, 输入回调额外参数)
                     # None 表示忽略
                     # 忽略注释, 无回调函数
-                    (None, PATTERN_COMMENT1),       # ignore
-                    (None, PATTERN_COMMENT2),       # ignore
-                    (None, PATTERN_COMMENT3),       # ignore
+                    (None, PATTERN_COMMENT),        # ignore
                     (None, PATTERN_WHITESPACE),     # ignore
-                    (self._handle_string, PATTERN_STRING1),
-                    (self._handle_string, PATTERN_STRING2),
-                    (self._handle_macro, PATTERN_GMACRO),
-                    (self._handle_integer, PATTERN_CINTEGER),
-                    (self._handle_float, PATTERN_NUMBER),
+                    (_handle_string, PATTERN_STRING1),
+                    (_handle_string, PATTERN_STRING2),
+                    (_handle_macro, PATTERN_GMACRO),
+                    (_handle_integer, PATTERN_CINTEGER),
+                    (_handle_float, PATTERN_NUMBER),
                     ('BAR', r'\|'),         # 产生式或符号
                     ('END', r'[;]'),        # 产生式结尾
                     (':', r'[:]'),          # 产生式分隔符
                     ('LEX', r'[@].*'),      # 词法
-                    ('NAME', PATTERN_GNAME),
-                    ('NAME', PATTERN_NAME),
-                    (self._handle_action, r'\{[^\{\}]*\}'),
+                    (_handle_name, PATTERN_GNAME),
+                    (_handle_name, PATTERN_NAME),
+                    (_handle_action, r'\{[^\{\}]*\}'),
                     (None, r'\%\%'),
                     ('OPERATOR', r'[\+\-\*\/\?\%]'),
                     ('MISMATCH', r'.'),
                 ]
         return spec
 
-    def _handle_string (self, value):
-        text = cstring.quoted_normalize(value)
-        return ('STRING', text)
-
-    def _handle_integer (self, value):
-        return ('NUMBER', cstring.string_to_int(value))
-
-    def _handle_float (self, value):
-        if '.' not in value:
-            return self._handle_integer(value)
-        return ('NUMBER', cstring.string_to_float(value))
-
-    def _handle_macro (self, value):
-        value = value.strip('\r\n\t ').replace(' ', '')
-        return ('MACRO', value)
-
-    def _handle_action (self, value):
-        value = value.strip('\r\n\t ')
-        return ('ACTION', value)
-
+    # 返回 [(line no, token list), ...]，行号递增
     def process (self, source):
-        tokens = {}     # line no -> token list
-        for token in tokenize(source, self.specific):
+        tokens = []
+        current = None
+        last_line = -1
+        for token in tokenize(source, self.specific, None, self.regex):
             # print(repr(token))
-            line_num = token.line
-            tokens.setdefault(line_num, []).append(token)
-            # print(token)
-        # print(tokens)
+            if token.line != last_line:
+                current = []
+                tokens.append((token.line, current))
+                last_line = token.line
+            current.append(token)
         return tokens
 
 
 #----------------------------------------------------------------------
 # load grammar file
 #----------------------------------------------------------------------
+_LEX_HEAD_RE = re.compile(r'[@]\s*(\w+)')
+_LEX_MATCH_RE = re.compile(r'(\{[^\{\}]*\}|\w+)\s+(.*)')
+_LEX_SPLIT_RE = re.compile(r'\W+')
+
 class GrammarLoader (object):
 
     def __init__ (self):
@@ -1594,11 +1824,8 @@ class GrammarLoader (object):
         self._cache = []
         self.srcinfo.clear()
         tokens = self.lex.process(self.source)
-        keys = list(tokens.keys())
-        keys.sort()
-        for line_num in keys:
+        for line_num, args in tokens:
             self.line_num = line_num
-            args = tokens[line_num]
             # 返回异常值
             hr = 0
             if not args:
@@ -1619,9 +1846,8 @@ class GrammarLoader (object):
             if len(self.g.production) > 0:
                 self.g.start = self.g.production[0].head
         if self.g.start:
-            symbol = self.g.start.__copy__()
-            symbol.term = (symbol.name in self.g.terminal)
-            self.g.start = symbol
+            name = self.g.start.name
+            self.g.start = _intern_symbol(name, name in self.g.terminal)
         for n in self.srcinfo:
             if not self.g.anchor_has(n):
                 t = self.srcinfo[n]
@@ -1667,18 +1893,16 @@ class GrammarLoader (object):
         elif argv[1].name != ':':
             self.error_token(argv[1], 'require ":" before "%s"'%(argv[1].value))
             return 4
-        cache = []
-        # 产生式右边
-        for arg in argv[2:]:
-            if arg.name == 'BAR':   # 产生式或符号 |
-                # hr 返回异常值
-                hr = self._add_rule(head, cache)
-                cache.clear()
-                if hr != 0:
-                    return hr
-            else:
-                cache.append(arg)
-        hr = self._add_rule(head, cache)
+        # 产生式右边，按 | 的位置切片
+        bars = [i for i, arg in enumerate(argv) if arg.name == 'BAR']
+        start = 2
+        for bar in bars:
+            # hr 返回异常值
+            hr = self._add_rule(head, argv[start:bar])
+            if hr != 0:
+                return hr
+            start = bar + 1
+        hr = self._add_rule(head, argv[start:])
         if hr != 0:
             return hr
         if not self.g.anchor_has(head):
@@ -1720,7 +1944,7 @@ class GrammarLoader (object):
                 pos += 1
             # 以上的 token 加入到 body
             elif token.name == 'MACRO':
-                cmd = token.value.strip()
+                cmd = token.value
                 pos += 1
                 if cmd == '%prec':
                     token = argv[pos]
@@ -1754,13 +1978,13 @@ class GrammarLoader (object):
         p = Production(head, body)
         p.precedence = precedence
         if len(action) > 0:
-            p.action = action
+            p.action = [action.get(i) for i in range(len(p.body) + 1)]
         # print('action:', action)
         self.g.append(p)
+        srcinfo = self.srcinfo
+        file_name = self.file_name
         for token in argv:
-            if token.value not in self.srcinfo:
-                t = (self.file_name, token.line)
-                self.srcinfo[token.value] = t
+            srcinfo.setdefault(token.value, (file_name, token.line))
         if argv:
             self.g.anchor_set(p, self.file_name, argv[0].line)
         return 0
@@ -1777,7 +2001,7 @@ class GrammarLoader (object):
                     return 1
                 self.g.push_token(n.value)
         elif cmd in ('%left', '%right', '%nonassoc', '%precedence'):
-            assoc = cmd[1:].strip()
+            assoc = cmd[1:]
             for n in argv:
                 if n.name not in ('NAME', 'STRING'):
                     # print('fuck', n)
@@ -1796,9 +2020,7 @@ class GrammarLoader (object):
             elif token.name != 'NAME':
                 self.error_token(token, 'must start from a non-terminal symbol')
                 return 4
-            symbol = load_symbol(argv[0].value)
-            if symbol.name in self.g.terminal:
-                symbol.term = True
+            symbol = self.g.create_symbol(argv[0].value)
             if symbol.term:
                 self.error_token(token, 'could not start from a terminal')
                 return 5
@@ -1809,11 +2031,11 @@ class GrammarLoader (object):
         assert len(args) == 1
         args[0].column = -1
         origin: str = args[0].value.strip('\r\n\t ')
-        m = re.match(r'[@]\s*(\w+)', origin)
+        m = _LEX_HEAD_RE.match(origin)
         if m is None:
             self.error_token(args[0], 'bad lex declaration')
             return 1
-        head: str = ('@' + m.group(1)).strip('\r\n\t ')
+        head: str = '@' + m.group(1)
         body: str = origin[m.span()[1]:].strip('\r\n\t ')
         if head in ('@ignore', '@skip'):
             if not validate_pattern(body):
@@ -1821,12 +2043,13 @@ class GrammarLoader (object):
                 return 2
             self.g.push_scanner(('ignore', body))
         elif head == '@match':
-            m = re.match(r'(\{[^\{\}]*\}|\w+)\s+(.*)', body)
+            m = _LEX_MATCH_RE.match(body)
             if m is None:
                 self.error_token(args[0], 'bad lex matcher definition')
                 return 3
-            name = m.group(1).strip('\r\n\t ')
-            pattern = m.group(2).strip('\r\n\t ')
+            # body 已经去掉首尾空白, \s+ 吃掉了中间的空白
+            name = m.group(1)
+            pattern = m.group(2)
             if not validate_pattern(pattern):
                 self.error_token(args[0], 'bad regex pattern: ' + repr(pattern))
                 return 4
@@ -1835,10 +2058,11 @@ class GrammarLoader (object):
             if not name.startswith('{'):
                 self.g.push_token(name)
         elif head == '@import':
-            part = re.split(r'\W+', body)
-            part = list(filter(lambda n: (n.strip('\r\n\t ') != ''), part))
+            part = _LEX_SPLIT_RE.split(body)
+            # 按 \W+ 切分后只剩单词或者空串
+            part = [n for n in part if n]
             if len(part) == 1:
-                name = part[0].strip()
+                name = part[0]
                 if not name:
                     self.error_token(args[0], 'expecting import name')
                     return 5
@@ -1849,15 +2073,15 @@ class GrammarLoader (object):
                 if not name.startswith('{'):
                     self.g.push_token(name)
             elif len(part) == 3:
-                name = part[0].strip()
+                name = part[0]
                 if not name:
                     self.error_token(args[0], 'expecting import name')
                     return 7
-                asname = part[2].strip()
+                asname = part[2]
                 if not asname:
                     self.error_token(args[0], 'expecting aliasing name')
                     return 8
-                if part[1].strip() != 'as':
+                if part[1] != 'as':
                     self.error_token(args[0], 'invalid import statement')
                     return 9
                 if name not in PATTERN:
@@ -1901,6 +2125,7 @@ MARK_VISITING = 1
 MARK_VISITED = 2
 
 EPSILON = Symbol('', False)
+EPSILON_BIT = 1             # FIRST/FOLLOW 位集合里 epsilon 占第 0 位
 EOF = Symbol('$', True)
 PSHARP = Symbol('#', True)  # P SHARP(#) is not in grammar
 
@@ -1915,6 +2140,9 @@ class SymbolInfo (object):
     E : epsilon '+';    E has epsilon but not is epsilon; has_epsilon = True, is_epsilon = False
     T : ;               T has epsilon and is epsilon; has_epsilon = True, is_epsilon = True
     """
+    __slots__ = ('symbol', 'mark', 'rules', 'rule_number', 'is_epsilon',
+                 'has_epsilon', 'sid')
+
     def __init__ (self, symbol):
         self.symbol = symbol
         self.mark = MARK_UNVISITED
@@ -1922,6 +2150,7 @@ class SymbolInfo (object):
         self.rule_number = 0
         self.is_epsilon = None
         self.has_epsilon = None     # has epsilon but maybe not is epsilon
+        self.sid = -1               # 符号编号，同 Grammar.sym_id
 
     def __copy__ (self):
         obj = SymbolInfo(self.symbol)
@@ -1955,6 +2184,38 @@ class SymbolInfo (object):
         return 0
 
 
+#----------------------------------------------------------------------
+# FIRST 集和 epsilon 标记的一致性检查表:
+# (FIRST 含 epsilon, FIRST 只有 epsilon, is_epsilon, has_epsilon) -> 错误信息
+#----------------------------------------------------------------------
+def _integrity_table ():
+    table = {}
+    for fe in (False, True):
+        for single in (False, True):
+            for ie in (False, True):
+                for he in (False, True):
+                    t = []
+                    if fe and single:
+                        if not ie:
+                            t.append('symbol %s is not epsilon but first set only contains epsilon')
+                        if not he:
+                            t.append('symbol %s has not epsilon but first set only contains epsilon')
+                    elif fe:
+                        if ie:
+                            t.append('symbol %s is epsilon but first set contains more than epsilon')
+                        if not he:
+                            t.append('symbol %s has not epsilon but first set contains epsilon')
+                    else:
+                        if ie:
+                            t.append('symbol %s is epsilon but first set does not contains epsilon')
+                        if he:
+                            t.append('symbol %s has epsilon but first set does not contains epsilon')
+                    table[(fe, single, ie, he)] = tuple(t)
+    return table
+
+_INTEGRITY_TABLE = _integrity_table()
+
+
 #----------------------------------------------------------------------
 # analyzer
 #----------------------------------------------------------------------
@@ -1971,6 +2232,20 @@ class GrammarAnalyzer (object):
         self.terminal = {}
         self.nonterminal = {}
         self.verbose = 2
+        # 终结符编号: bit i 代表第 i 个终结符, epsilon 固定为 EPSILON_BIT
+        self._tid = {}
+        self._tnames = []
+        self._first_bits = {}       # symbol name -> FIRST 位集合
+        self._first_ids = []        # sid -> FIRST 位集合
+        self._follow_bits = {}      # symbol name -> FOLLOW 位集合
+        self._first_cache = {}      # symbol tuple -> FIRST 位集合
+        self._suffix_bits = {}      # production index -> 各位置之后符号串的 FIRST 位集合
+        self._select_bits = {}      # production index -> SELECT 位集合
+        self._infos = []            # sid -> SymbolInfo
+        self._body_infos = []       # production index -> 右边符号的 SymbolInfo
+        self.rules_by_nt = []       # sid -> 去重后的产生式列表, 终结符为 None
+        self._nullable_cache = {}   # symbol tuple -> (is_epsilon, has_epsilon)
+        self._adj = None            # symbol name -> 子符号名, 见 __adjacency()
 
     def process (self, expand_action = True):
         if expand_action:
@@ -1989,9 +2264,18 @@ class GrammarAnalyzer (object):
         self.info.clear()
         self.terminal.clear()
         self.nonterminal.clear()
+        self._tid.clear()
+        self._tnames.clear()
+        # epsilon 第一个编号, 对应 EPSILON_BIT
+        self.term_bit(EPSILON.name)
         g = self.g
+        g.compile_soa()
+        # sid -> SymbolInfo, 按编号直接索引
+        self._infos = [None] * len(g.sym_table)
         for name in g.symbol:
             info = SymbolInfo(g.symbol[name])
+            info.sid = g.sym_id[name]
+            self._infos[info.sid] = info
             self.info[name] = info
             info.reset()
             rules = g.rule.get(name, [])
@@ -2001,6 +2285,22 @@ class GrammarAnalyzer (object):
                 self.terminal[info.name] = info.symbol
             else:
                 self.nonterminal[info.name] = info.symbol
+        self._adj = None
+        # 每条产生式右边符号的 SymbolInfo 只查一次
+        infos = self._infos
+        self._body_infos = [tuple([infos[i] for i in ids]) for ids in g.body_ids]
+        # 重复的产生式 (head/body 相同) 生成的项目和第一条完全一样，只保留第一条
+        self.rules_by_nt = [None] * len(infos)
+        for info in infos:
+            if info.is_terminal or info.name not in g.rule:
+                continue
+            rules = []
+            seen = set()
+            for rule in info.rules:
+                if rule not in seen:
+                    seen.add(rule)
+                    rules.append(rule)
+            self.rules_by_nt[info.sid] = rules
         return 0
 
     '''
@@ -2040,55 +2340,128 @@ class GrammarAnalyzer (object):
         if (not change)
             break
     '''
+    # FIRST 集用整数位集合计算, 并集就是按位或, 最后再转回 set;
+    # 不动点在 compile_soa() 的符号编号上进行，循环里只有列表下标和整数运算
     def __update_first_set (self):
-        self.FIRST.clear()
-        for name in self.g.symbol:
-            symbol = self.g.symbol[name]
-            if symbol.term:
-                self.FIRST[name] = set([name])
-            else:
-                self.FIRST[name] = set()
-        self.FIRST['$'] = set(['$'])
-        self.FIRST['#'] = set(['#'])
-        while 1:
-            changes = 0
-            for symbol in self.nonterminal:
-                info = self.info[symbol]
-                for rule in info.rules:
-                    first = self.__calculate_first_set(rule.body)
-                    # add terminal, which not in self.FIRST, in "first" to "self.FIRST"
-                    for n in first:
-                        # 如果 n 不存在 first 集合中，加入集合中并且标注已经被修改过
-                        if n not in self.FIRST[symbol]:
-                            self.FIRST[symbol].add(n)
-                            changes += 1
-            if not changes:
-                break
+        g = self.g
+        g.compile_soa()
+        table = g.sym_table
+        mask = g.term_mask
+        body_ids = g.body_ids
+        infos = self._infos
+        eps = EPSILON_BIT
+        noeps = ~EPSILON_BIT
+        # fb[id]: 符号 id 的 FIRST 位集合
+        fb = [0] * len(table)
+        for i, symbol in enumerate(table):
+            if mask[i]:
+                fb[i] = self.term_bit(symbol.name)
+        # 每条规则预先拆成: 开头连续的非终结符编号 + 结尾的位
+        # (遇到的第一个终结符，全是非终结符时为 epsilon 位)
+        # 同时建立依赖: 前缀都可能为空时，FIRST(A) 依赖 FIRST(B)
+        shapes = {}
+        depends = {}
+        info_map = self.info
+        sym_id = g.sym_id
+        for name in self.nonterminal:
+            rows = []
+            edges = {}
+            for rule in info_map[name].rules:
+                ids = []
+                tail = eps
+                nullable = True
+                for i in body_ids[rule.index]:
+                    if mask[i]:
+                        tail = fb[i]
+                        break
+                    ids.append(i)
+                    if nullable:
+                        edges[i] = 1
+                        # 没有确定不为空的都当作可能为空
+                        if infos[i].has_epsilon is False:
+                            nullable = False
+                rows.append((ids, tail))
+            sid = sym_id[name]
+            shapes[sid] = rows
+            depends[sid] = list(edges)
+        # 按依赖关系的逆拓扑序处理，不动点只在强连通分量内部迭代
+        for component in internal.scc(shapes, depends.__getitem__):
+            cyclic = len(component) > 1 or (component[0] in depends[component[0]])
+            while 1:
+                changes = 0
+                for sid in component:
+                    first = fb[sid]
+                    for ids, tail in shapes[sid]:
+                        x = 0
+                        for i in ids:
+                            f = fb[i]
+                            x |= f
+                            # 不能为空就停下, 去掉 epsilon
+                            if not f & eps:
+                                x &= noeps
+                                break
+                        else:
+                            x = (x & noeps) | tail
+                        first |= x
+                    # 集合增大了才算修改
+                    if first != fb[sid]:
+                        fb[sid] = first
+                        changes += 1
+                if not changes or not cyclic:
+                    break
+        self._first_ids = fb
+        bits = self._first_bits
+        bits.clear()
+        for i, symbol in enumerate(table):
+            bits[symbol.name] = fb[i]
+        bits['$'] = self.term_bit('$')
+        bits['#'] = self.term_bit('#')
+        FIRST = self.FIRST
+        bits_to_set = self.bits_to_set
+        FIRST.clear()
+        for name, value in bits.items():
+            FIRST[name] = bits_to_set(value)
+        # FIRST 集稳定以后才开始缓存符号串的 FIRST
+        self._first_cache.clear()
+        self._suffix_bits.clear()
         return 0
 
-    def __calculate_first_set (self, vector):
-        output = set([])
-        index = 0
+    # 终结符名字 -> 位, 每个终结符第一次出现时分配一个编号
+    def term_bit (self, name):
+        tid = self._tid.get(name)
+        if tid is None:
+            tid = len(self._tnames)
+            self._tid[name] = tid
+            self._tnames.append(name)
+        return 1 << tid
+
+    # 位集合 -> 终结符名字集合
+    def bits_to_set (self, bits):
+        names = self._tnames
+        output = set()
+        while bits:
+            low = bits & -bits
+            output.add(names[low.bit_length() - 1])
+            bits ^= low
+        return output
+
+    def __calculate_first_bits (self, vector):
+        output = 0
         for symbol in vector:
             if symbol.term:
-                output.add(symbol.name)
-                break
+                return output | self.term_bit(symbol.name)
             # symbol is non-terminal
-            if symbol.name not in self.FIRST:
-                for key in self.FIRST.keys():
+            first = self._first_bits.get(symbol.name)
+            if first is None:
+                for key in self._first_bits.keys():
                     print('FIRST:', key)
                 raise ValueError('FIRST set does not contain %r'%symbol.name)
             # add terminal to first except epsilon
-            for name in self.FIRST[symbol.name]:
-                if name != EPSILON:
-                    output.add(name)
+            output |= first & ~EPSILON_BIT
             # if left body of production has epsilon, continue to find
-            if EPSILON not in self.FIRST[symbol.name]:
-                break
-            index += 1
-        if index >= len(vector):
-            output.add(EPSILON.name)
-        return output
+            if not first & EPSILON_BIT:
+                return output
+        return output | EPSILON_BIT
 
     '''
     FOLLOW 集的不动点算法:
@@ -2114,8 +2487,12 @@ class GrammarAnalyzer (object):
         if (not change)
             break
     '''
+    # 工作表算法: 先一次性算出每个位置由右边 FIRST 贡献的部分，
+    # 剩下的只有 FOLLOW(head) -> FOLLOW(symbol) 的传递边，
+    # 只有 FOLLOW 集变大的符号才会继续向后传递
     def __update_follow_set (self):
         self.FOLLOW.clear()
+        self._follow_bits.clear()
         start = self.g.start
         if not self.g.start:
             if len(self.g) > 0:
@@ -2123,56 +2500,87 @@ class GrammarAnalyzer (object):
         if not start:
             internal.echo_error('start point is required')
             return 0
-        FOLLOW = self.FOLLOW
+        g = self.g
+        sym_id = g.sym_id
+        mask = g.term_mask
+        body_ids = g.body_ids
+        fb = self._first_ids
+        eps = EPSILON_BIT
+        noeps = ~EPSILON_BIT
+        # fw[id]: 符号 id 的 FOLLOW 位集合
+        fw = [0] * len(g.sym_table)
+        eof = self.term_bit('$')
+        sid = sym_id.get(start.name)
+        if sid is not None:
+            fw[sid] = eof
+        # 符号 id -> FOLLOW 要包含其 FOLLOW 的左部 id
+        feeds = {}
+        for p in g.production:
+            head = sym_id[p.head.name]
+            # 从右往左累积后缀的 FIRST 集, epsilon 位表示后缀可以为空,
+            # 每个位置的后缀 FIRST 只算一次, 也不用切片
+            suffix = eps
+            for i in reversed(body_ids[p.index]):
+                first = fb[i]
+                if mask[i]:
+                    suffix = first
+                    continue
+                fw[i] |= suffix & noeps
+                if suffix & eps and i != head:
+                    feeds.setdefault(i, []).append(head)
+                if first & eps:
+                    suffix = (first & noeps) | suffix
+                else:
+                    suffix = first
+        # 和 FIRST 一样按强连通分量的逆拓扑序处理: 左部先于右部算完,
+        # 同一分量里的 FOLLOW 互相包含, 一定相等, 每个分量只并一次
+        for component in internal.scc(list(feeds), lambda i: feeds.get(i, ())):
+            bits = 0
+            for i in component:
+                bits |= fw[i]
+                for head in feeds.get(i, ()):
+                    bits |= fw[head]
+            for i in component:
+                fw[i] = bits
+        follow = self._follow_bits
         for n in self.nonterminal:
-            FOLLOW[n] = set([])
-        FOLLOW[start.name] = set(['$'])
-        while 1:
-            changes = 0
-            for p in self.g:
-                for i, symbol in enumerate(p.body):
-                    # skip leftmost terminal
-                    if symbol.term:
-                        continue
-                    follow = p.body[i + 1:]
-                    first = self.vector_first_set(follow)
-                    epsilon = False
-                    # follow(head) add follow(symbol) if epsilon in first set which follows symbol
-                    for n in first:
-                        if n != EPSILON.name:
-                            if n not in FOLLOW[symbol.name]:
-                                FOLLOW[symbol.name].add(n)
-                                changes += 1
-                        else:
-                            epsilon = True
-                    if epsilon or i == len(p.body) - 1:
-                        for n in FOLLOW[p.head]:
-                            if n not in FOLLOW[symbol.name]:
-                                FOLLOW[symbol.name].add(n)
-                                changes += 1
-            if not changes:
-                break
+            follow[n] = fw[sym_id[n]]
+        if start.name not in follow:
+            follow[start.name] = (sid is not None) and fw[sid] or eof
+        FOLLOW = self.FOLLOW
+        bits_to_set = self.bits_to_set
+        for name, value in follow.items():
+            FOLLOW[name] = bits_to_set(value)
         return 0
 
+    # SELECT = FIRST(body), 可以为空时去掉 epsilon 再并上 FOLLOW(head)
     def __update_select_set (self):
-        for i, p in enumerate(self.g):
-            first = self.vector_first_set(p.body)
-            if not '' in first:
-                self.SELECT[i] = first
-            else:
-                self.SELECT[i] = (first - set([''])) | self.FOLLOW[p.head]
-
+        select = self._select_bits
+        select.clear()
+        follow = self._follow_bits
+        SELECT = self.SELECT
+        vector_first_bits = self.vector_first_bits
+        bits_to_set = self.bits_to_set
+        for i, p in enumerate(self.g.production):
+            first = vector_first_bits(p.body)
+            if first & EPSILON_BIT:
+                first = (first & ~EPSILON_BIT) | follow[p.head.name]
+            select[i] = first
+            SELECT[i] = bits_to_set(first)
+
+    # 同一个非终结符的各个 SELECT 集两两不相交:
+    # 累积按位或，和已有的位有交集就不是 LL(1)
     def is_LL1 (self):
+        select = self._select_bits
         for rule in self.g.rule.values():
             if len(rule) <= 1:
                 continue
-            select = []
+            acc = 0
             for p in rule:
-                select.append((p.index, self.SELECT[p.index]))
-            for i in range(len(select)):
-                for j in range(i):
-                    if select[i][1] & select[j][1]:
-                        return False
+                bits = select[p.index]
+                if acc & bits:
+                    return False
+                acc |= bits
         return True
 
     def __update_epsilon (self):
@@ -2199,14 +2607,29 @@ class GrammarAnalyzer (object):
                 elif is_count > 0:
                     info.has_epsilon = True
 
-        while True:
-            count = 0
-            for p in g.production:
-                count += self.__update_epsilon_production(p)
-            for info in self.info.values():
-                count += self.__update_epsilon_symbol(info)
-            if not count:
-                break
+        # 工作表: 符号的状态确定以后，只重新检查用到它的产生式，
+        # 产生式的状态确定以后，只重新检查它的左边符号
+        users = {}
+        for p in g.production:
+            for n in p.body:
+                plist = users.setdefault(n.name, [])
+                if not plist or plist[-1] is not p:
+                    plist.append(p)
+        pending_p = list(g.production)
+        pending_s = list(self.info.values())
+        while pending_p or pending_s:
+            while pending_p:
+                p = pending_p.pop()
+                if self.__update_epsilon_production(p):
+                    info = self.info.get(p.head.name)
+                    if info is not None:
+                        pending_s.append(info)
+            while pending_s:
+                info = pending_s.pop()
+                if self.__update_epsilon_symbol(info):
+                    pending_p.extend(users.get(info.name, ()))
+        # 符号的状态变了, 之前缓存的结果作废
+        self._nullable_cache.clear()
         return 0
 
     def __update_epsilon_symbol (self, info: SymbolInfo):
@@ -2264,8 +2687,7 @@ class GrammarAnalyzer (object):
         isnot_count = 0
         has_count = 0
         hasnot_count = 0
-        for n in p.body:
-            info = self.info[n.name]
+        for info in self._body_infos[p.index]:
             if info.is_epsilon:
                 is_count += 1
             elif info.is_epsilon is not None:
@@ -2291,49 +2713,61 @@ class GrammarAnalyzer (object):
                 count += 1
         return count
 
-    def vector_is_epsilon (self, vector: Vector):
-        if vector.leftmost_terminal() is not None:
-            return False
-        is_count = 0
-        isnot_count = 0
-        for symbol in vector:
-            if symbol.name not in self.info:
-                continue
-            info = self.info[symbol.name]
-            if info.is_epsilon:
-                is_count += 1
-            elif info.is_epsilon is not None:
-                isnot_count += 1
-        if is_count >= len(vector):
-            return True
-        return False
-
-    def vector_has_epsilon (self, vector: Vector):
+    # 一次遍历同时算出 (is_epsilon, has_epsilon)，结果按符号串缓存
+    def __vector_epsilon (self, vector: Vector):
+        key = vector.m
+        cache = self._nullable_cache.get(key)
+        if cache is not None:
+            return cache
         if vector.leftmost_terminal() is not None:
-            return False
+            cache = (False, False)
+            self._nullable_cache[key] = cache
+            return cache
         is_count = 0
-        isnot_count = 0
         has_count = 0
-        hasnot_count = 0
         for symbol in vector:
             if symbol.name not in self.info:
                 continue
             info = self.info[symbol.name]
             if info.is_epsilon:
                 is_count += 1
-            elif info.is_epsilon is not None:
-                isnot_count += 1
             if info.has_epsilon:
                 has_count += 1
-            elif info.has_epsilon is not None:
-                hasnot_count += 1
         size = len(vector)
-        if (is_count >= size) or (has_count >= size):
-            return True
-        return False
+        is_epsilon = (is_count >= size)
+        cache = (is_epsilon, is_epsilon or (has_count >= size))
+        self._nullable_cache[key] = cache
+        return cache
+
+    def vector_is_epsilon (self, vector: Vector):
+        return self.__vector_epsilon(vector)[0]
+
+    def vector_has_epsilon (self, vector: Vector):
+        return self.__vector_epsilon(vector)[1]
+
+    # FIRST 集算好以后，同一个符号串的 FIRST 只算一次
+    def vector_first_bits (self, vector):
+        if isinstance(vector, Vector):
+            key = vector.m
+        else:
+            key = tuple(vector)
+        bits = self._first_cache.get(key)
+        if bits is None:
+            bits = self.__calculate_first_bits(key)
+            self._first_cache[key] = bits
+        return bits
+
+    # 产生式 p 右边从 pos 开始的后缀的 FIRST 位集合，按产生式编号缓存
+    def suffix_first_bits (self, p: Production, pos):
+        suffix = self._suffix_bits.get(p.index)
+        if suffix is None:
+            body = tuple(p.body)
+            suffix = [self.vector_first_bits(body[i:]) for i in range(len(body) + 1)]
+            self._suffix_bits[p.index] = suffix
+        return suffix[pos]
 
     def vector_first_set (self, vector):
-        return self.__calculate_first_set(vector)
+        return self.bits_to_set(self.vector_first_bits(vector))
 
     def __integrity_error (self, *args):
         text = ' '.join(args)
@@ -2356,46 +2790,20 @@ class GrammarAnalyzer (object):
 
     def __check_integrity (self):
         error = 0
+        first_bits = self._first_bits
+        table = _INTEGRITY_TABLE
         for info in self.info.values():
             symbol = info.symbol
             if symbol.term:
                 continue
             name = symbol.name
-            first = self.FIRST[name]
-            if EPSILON.name in first:
-                if len(first) == 1:
-                    if not info.is_epsilon:
-                        t = 'symbol %s is not epsilon but '%name
-                        t += 'first set only contains epsilon'
-                        self.__integrity_error(t)
-                        error += 1
-                    if not info.has_epsilon:
-                        t = 'symbol %s has not epsilon but '%name
-                        t += 'first set only contains epsilon'
-                        self.__integrity_error(t)
-                        error += 1
-                elif len(first) > 0:
-                    if info.is_epsilon:
-                        t = 'symbol %s is epsilon but '%name
-                        t += 'first set contains more than epsilon'
-                        self.__integrity_error(t)
-                        error += 1
-                    if not info.has_epsilon:
-                        t = 'symbol %s has not epsilon but '%name
-                        t += 'first set contains epsilon'
-                        self.__integrity_error(t)
-                        error += 1
-            else:
-                if info.is_epsilon:
-                    t = 'symbol %s is epsilon but '%name
-                    t += 'first set does not contains epsilon'
-                    self.__integrity_error(t)
-                    error += 1
-                if info.has_epsilon:
-                    t = 'symbol %s has epsilon but '%name
-                    t += 'first set does not contains epsilon'
-                    self.__integrity_error(t)
-                    error += 1
+            bits = first_bits[name]
+            # (FIRST 含 epsilon, FIRST 只有 epsilon, is_epsilon, has_epsilon)
+            key = (bool(bits & EPSILON_BIT), bits == EPSILON_BIT,
+                   bool(info.is_epsilon), bool(info.has_epsilon))
+            for t in table[key]:
+                self.__integrity_error(t%name)
+                error += 1
         if error and 0:
             sys.exit(1)
         return error
@@ -2405,12 +2813,18 @@ class GrammarAnalyzer (object):
             info.mark = init
         return 0
 
-    def __iter_child (self, symbol):
-        if symbol in self.g.rule:
-            for rule in self.g.rule[symbol]:
-                for n in rule.body:
-                    yield n.name
-        return None
+    # 符号名 -> 所有规则右边出现的符号名 (去重, 保持出现顺序)
+    def __adjacency (self):
+        if self._adj is None:
+            adj = {}
+            for name, rules in self.g.rule.items():
+                children = {}
+                for rule in rules:
+                    for n in rule.body:
+                        children[n.name] = 1
+                adj[name] = tuple(children)
+            self._adj = adj
+        return self._adj
 
     def find_reachable (self, parents):
         output = []
@@ -2424,58 +2838,71 @@ class GrammarAnalyzer (object):
             roots = [parents.name]
         else:
             roots = parents
-        for symbol in internal.bfs(roots, self.__iter_child):
+        adj = self.__adjacency()
+        empty = ()
+        for symbol in internal.bfs(roots, lambda n: adj.get(n, empty)):
             output.append(symbol)
         return output
 
     def find_undefined_symbol (self):
         undefined = set([])
+        terminal = self.g.terminal
+        rule = self.g.rule
         # sname: symbol name
         for sname in self.g.symbol:
-            if sname in self.g.terminal:
+            if sname in terminal:
                 continue
-            if sname not in self.g.rule:
-                if sname not in undefined:
-                    undefined.add(sname)
-            elif len(self.g.rule[sname]) == 0:
-                if sname not in undefined:
-                    undefined.add(sname)
+            # 没有规则或者规则为空
+            if not rule.get(sname):
+                undefined.add(sname)
         return list(undefined)
 
     # symbol can deduce production which only include terminals
     '''
-    为什么要多次查找 ?
+    不用多次查找, 用计数器:
     例如文法:
         list: elem;
         elem: ID;
-    第一趟只找到 elem;      terminated = [elem]
-    第二趟才能找到 list;    terminated = [elem, list]
+    每条规则记录右边还有几个符号不能推导出终结符，
+    elem 确定以后, 用到 elem 的规则 list: elem 计数减到 0, list 也就确定了
     '''
     def find_terminated_symbol (self):
         terminated = set([])
         for symbol in self.g.symbol.values():
             if symbol.term:
                 terminated.add(symbol.name)
-        while 1:
-            changes = 0
-            for symbol in self.g.symbol.values():
-                if symbol.name in terminated:
-                    continue
-                elif symbol.name not in self.g.rule:
+        queue = []
+        heads = []          # 规则编号 -> 左边符号名
+        remaining = []      # 规则编号 -> 右边还没确定的符号个数
+        usage = {}          # 符号名 -> 用到它的规则编号
+        for symbol in self.g.symbol.values():
+            name = symbol.name
+            if name in terminated:
+                continue
+            elif name not in self.g.rule:
+                continue
+            for rule in self.g.rule[name]:
+                pending = set([n.name for n in rule.body if n.name not in terminated])
+                if not pending:
+                    # 产生式右边的符号都能推导出终结符
+                    if name not in terminated:
+                        terminated.add(name)
+                        queue.append(name)
                     continue
-                for rule in self.g.rule[symbol.name]:
-                    can_terminate = True    # 产生式右边的符号都能推导出终结符
-                    for n in rule.body:
-                        if n.name not in terminated:
-                            can_terminate = False
-                            break
-                    if can_terminate:
-                        if symbol.name not in terminated:
-                            terminated.add(symbol.name)
-                            changes += 1
-                        break
-            if not changes:
-                break
+                index = len(heads)
+                heads.append(name)
+                remaining.append(len(pending))
+                for n in pending:
+                    usage.setdefault(n, []).append(index)
+        while queue:
+            name = queue.pop()
+            for index in usage.get(name, ()):
+                remaining[index] -= 1
+                if remaining[index] == 0:
+                    head = heads[index]
+                    if head not in terminated:
+                        terminated.add(head)
+                        queue.append(head)
         return list(terminated)
 
     def check_grammar (self):
@@ -2564,11 +2991,10 @@ class GrammarAnalyzer (object):
                 rules.append(rule)
                 anchors.append(anchor)
                 continue
-            count = 0
-            for key in rule.action.keys():
-                if key < len(rule):
-                    count += 1
-            if count == 0:
+            # action 是按位置排列的列表, 最后一项是产生式末尾的动作,
+            # 前面的都是内嵌动作
+            size = len(rule)
+            if not any(rule.action[:size]):
                 rules.append(rule)
                 anchors.append(anchor)
                 continue
@@ -2577,13 +3003,12 @@ class GrammarAnalyzer (object):
             children = []   # 所有内嵌语义动作的标记 M 产生式
             # T -> F {T'.inh = F.val} T' {T.val = T'.val}
             for pos, symbol in enumerate(rule.body):
-                if pos in rule.action:
+                if rule.action[pos]:
                     head = Symbol('M@%d'%name_id, False)
                     name_id += 1
                     # M1 -> ε {M1.i = F.val; M1.syn = M1.i}
                     child = Production(head, [])    # M → ε
-                    child.action = {}
-                    child.action[0] = []
+                    child.action = [[]]
                     stack_pos = len(body)       # 记录非终结符 M 在产生式右边的位置
                     # T -> F {T'.inh = F.val} T' {T.val = T'.val}
                     #              ^                    ^
@@ -2599,19 +3024,12 @@ class GrammarAnalyzer (object):
             # T -> F M1 T' {T.val = T'.val}
             root = Production(rule.head, body)
             root.precedence = rule.precedence
-            action = {}
             stack_pos = len(body)
             # 产生式最右边的语法动作
-            keys = list(filter(lambda k: k >= len(rule), rule.action.keys()))
-            keys.sort()
-            # print('keys', keys)
-            for key in keys:
-                assert key >= len(rule)
-                for act in rule.action[key]:
-                    if stack_pos not in action:
-                        action[stack_pos] = []
-                    action[stack_pos].append((act[0], stack_pos))
-            if action:
+            trailing = rule.action[size]
+            if trailing:
+                action = [None] * (stack_pos + 1)
+                action[stack_pos] = [(act[0], stack_pos) for act in trailing]
                 root.action = action
             # 先将原来的产生式加入到 rules, 再将所有标记符 M 的产生式加入到 rules
             rules.append(root)
@@ -2628,13 +3046,24 @@ class GrammarAnalyzer (object):
         self.g.update()
         return 0
 
+    # s 可以是名字集合, 也可以是 FIRST/FOLLOW 的位集合
     def set_to_text (self, s):
-        t = []
-        if len(s) == 0:
+        if isinstance(s, int):
+            s = self.__bits_names(s)
+        elif len(s) == 0:
             return '{ }'
-        for n in s:
-            t.append((n == '') and '<empty>' or n)
-        return '{ %s }'%(', '.join(t),)
+        text = ', '.join(('<empty>' if n == '' else n) for n in s)
+        if not text:
+            return '{ }'
+        return '{ %s }'%(text,)
+
+    # 按编号顺序逐个取出位集合里的名字
+    def __bits_names (self, bits):
+        names = self._tnames
+        while bits:
+            low = bits & -bits
+            yield names[low.bit_length() - 1]
+            bits ^= low
 
     def print_epsilon (self):
         rows = []
@@ -2673,9 +3102,37 @@ class RulePtr (object):
         self.rule = production
         self.index = index
         self.lookahead = lookahead    # None or a string, follow subset(production.head)
+        # 圆点后的符号和是否到达末尾, 构造时算好, 热点循环里直接读属性
+        body = production.body
+        self._satisfied = (index >= len(body))
+        self._next = None if self._satisfied else body[index]
+        self._next_name = None if self._satisfied else self._next.name
+        self._shift = None  # advance() 的结果, 第一次调用时算好
+        # 排序用的键, 和 __ge__/__gt__ 的比较顺序一致: 圆点位置, 向前看符号,
+        # 产生式左部, 右部符号名; 内核排序时不用再走 Python 层的比较函数
+        self._order = (index, repr(lookahead), production._order)
         self.__name = None
         self.__hash = None
         self.__text = None
+        self.uid = None     # 享元项目的整数编号, 直接构造的项目为 None
+
+    # 同一产生式、同一圆点位置、同一向前看符号只创建一个 RulePtr,
+    # 项目不可修改, 相等判断多数情况下退化为 is 比较, name/hash 也只算一次
+    @staticmethod
+    def intern (production: Production, index: int, lookahead = None):
+        key = (index, lookahead)
+        rp = production._items.get(key)
+        if rp is None:
+            rp = RulePtr(production, index, lookahead)
+            rp.uid = id(rp)
+            production._items[key] = rp
+        return rp
+
+    # 享元编号, 直接构造的项目取与其相等的享元项目的编号
+    def identity (self) -> int:
+        if self.uid is None:
+            self.uid = RulePtr.intern(self.rule, self.index, self.lookahead).uid
+        return self.uid
 
     def __len__ (self) -> int:
         return len(self.rule)
@@ -2688,20 +3145,20 @@ class RulePtr (object):
 
     @property
     def next (self) -> Symbol:
-        if self.index >= len(self.rule.body):
-            return None
-        return self.rule.body[self.index]
+        return self._next
 
     # generate new RulePtr object if advance
     def advance (self):
-        if self.index >= len(self.rule.body):
+        if self._satisfied:
             return None
-        return RulePtr(self.rule, self.index + 1, self.lookahead)
+        if self._shift is None:
+            self._shift = RulePtr.intern(self.rule, self.index + 1, self.lookahead)
+        return self._shift
 
     # dot is at rightmost production
     @property
     def satisfied (self) -> bool:
-        return (self.index >= len(self.rule))
+        return self._satisfied
 
     def __str__ (self) -> str:
         if self.__text is not None:
@@ -2732,6 +3189,8 @@ class RulePtr (object):
         return self.__hash
 
     def __eq__ (self, rp) -> bool:
+        if self is rp:
+            return True
         assert isinstance(rp, RulePtr)
         if (self.index == rp.index) and (self.lookahead == rp.lookahead):
             return (self.rule == rp.rule)
@@ -2801,8 +3260,9 @@ class LRItemSet (object):
         # 内核项
         self.kernel = LRItemSet.create_kernel(kernel_source)
         self.closure = []
-        # 标记非内核项的位置
-        self.checked = {}
+        # 已加入 closure 的项目编号
+        self.checked_ids = set()
+        self.__key = None
         self.__hash = None
         self.__name = None
         self.uuid = -1
@@ -2810,10 +3270,19 @@ class LRItemSet (object):
     @staticmethod
     def create_kernel (kernel_source):
         klist = [n for n in kernel_source]
-        klist.sort()
+        klist.sort(key = lambda n: n._order)
         return tuple(klist)
 
-    # 内核项作为状态名即可，因为项集的内核项相同，非内核项一定也相同，都是又传播和自发生成而来的
+    # 内核项作为状态的键即可，因为项集的内核项相同，非内核项一定也相同，都是又传播和自发生成而来的
+    # 用享元项目编号排序后的 tuple 做键，不用排序 RulePtr，也不用拼接字符串
+    @staticmethod
+    def create_key (kernel_source):
+        # 享元项目的 uid 已经有了 (id 不会是 0), 只有直接构造的项目才查享元表
+        uids = [n.uid or n.identity() for n in kernel_source]
+        uids.sort()
+        return tuple(uids)
+
+    # 可读的状态名，只在打印时使用
     @staticmethod
     def create_name (kernel_source):
         knl = LRItemSet.create_kernel(kernel_source)
@@ -2829,38 +3298,55 @@ class LRItemSet (object):
 
     def __getitem__ (self, key):
         if isinstance(key, str):
-            index = self.checked[key]
-            return self.closure[index]
+            # 按项目名查找只有调试打印时用到，直接线性查找
+            for rp in self.closure:
+                if rp.name == key:
+                    return rp
+            raise KeyError(key)
         return self.closure[key]
 
     def __contains__ (self, key):
         if isinstance(key, int):
             return ((key >= 0) and (key < len(self.closure)))
         elif isinstance(key, RulePtr):
-            return (key.name in self.checked)
+            return (key.identity() in self.checked_ids)
         elif isinstance(key, str):
-            return (key in self.checked)
+            return any(rp.name == key for rp in self.closure)
         return False
 
     def clear (self):
         self.closure.clear()
-        self.checked.clear()
+        self.checked_ids.clear()
+        return 0
+
+    # 换一组内核项重新使用这个项集，用作临时求 closure 的缓冲区
+    def reset (self, kernel_source: list[RulePtr]):
+        self.kernel = LRItemSet.create_kernel(kernel_source)
+        self.clear()
+        self.__key = None
+        self.__hash = None
+        self.__name = None
+        self.uuid = -1
         return 0
 
     def __hash__ (self):
         if self.__hash is None:
-            self.__hash = hash(self.kernel)
+            self.__hash = hash(self.key)
         return self.__hash
 
+    # 键是整数 tuple, dict/set 已经先比较过哈希, 这里直接比较键
     def __eq__ (self, obj):
-        assert isinstance(obj, LRItemSet)
-        if hash(self) != hash(obj):
-            return False
-        return (self.kernel == obj.kernel)
+        return (self is obj) or (self.key == obj.key)
 
     def __ne__ (self, obj):
         return (not (self == obj))
 
+    @property
+    def key (self):
+        if self.__key is None:
+            self.__key = LRItemSet.create_key(self.kernel)
+        return self.__key
+
     @property
     def name (self):
         if self.__name is None:
@@ -2868,11 +3354,12 @@ class LRItemSet (object):
         return self.__name
 
     def append (self, item: RulePtr):
-        if item.name in self.checked:
+        uid = item.identity()
+        if uid in self.checked_ids:
             LOG_ERROR('duplicated item:', item)
-            assert item.name not in self.checked
+            assert uid not in self.checked_ids
             return -1
-        self.checked[item.name] = len(self.closure)
+        self.checked_ids.add(uid)
         self.closure.append(item)
         return 0
 
@@ -2885,13 +3372,43 @@ class LRItemSet (object):
         checked = set([])
         # rp: rule pointer
         for rp in self.closure:
-            if rp.next is None:
+            name = rp._next_name
+            if name is None:
                 continue
-            if rp.next.name not in checked:
-                checked.add(rp.next.name)
-                output.append(rp.next)
+            if name not in checked:
+                checked.add(name)
+                output.append(rp._next)
         return output
 
+    # 圆点后是 X 的项目移进一位，得到 GOTO(I, X) 的内核项
+    def goto_kernel (self, X: Symbol):
+        name = X.name
+        kernel = []
+        for rp in self.closure:
+            if rp._next_name == name:
+                shift = rp._shift
+                if shift is None:
+                    shift = rp.advance()
+                kernel.append(shift)
+        return kernel
+
+    # 一遍扫描 closure, 按圆点后的符号把移进一位的项目分组,
+    # 得到每个符号 GOTO 的内核项: [(symbol, kernel_list) ...], 符号顺序同 find_expecting_symbol
+    def goto_kernels (self):
+        buckets = {}
+        for rp in self.closure:
+            name = rp._next_name
+            if name is None:
+                continue
+            shift = rp._shift
+            if shift is None:
+                shift = rp.advance()
+            bucket = buckets.get(name)
+            if bucket is None:
+                bucket = buckets[name] = (rp._next, [])
+            bucket[1].append(shift)
+        return list(buckets.values())
+
     def print (self):
         rows = []
         print('STATE(%d): %s'%(self.uuid, self.name))
@@ -2914,6 +3431,9 @@ class ActionName (IntEnum):
     ACCEPT = 2
     ERROR = 3
 
+# ActionName 的首字母，按值索引，打印表格时不用每次构造枚举
+_ACTION_CHARS = ('S', 'R', 'A', 'E')
+
 
 #----------------------------------------------------------------------
 # Action: include action and goto
@@ -2925,16 +3445,21 @@ class Action (object):
         self.name = name
         self.target = target
         self.rule = rule
+        # name 和 target 创建后不再修改，比较用的键和哈希都先算好
+        # 哈希保持和 (name, target) 一致，表格单元 set 的遍历顺序不变
+        # name 只有 0-3，占低两位，不会和 target 混叠
+        self._key = (target << 2) | int(name)
+        self._hash = hash((name, target))
 
     def __eq__ (self, obj):
         assert isinstance(obj, Action)
-        return (self.name == obj.name and self.target == obj.target)
+        return (self._key == obj._key)
 
     def __ne__ (self, obj):
         return (not (self == obj))
 
     def __hash__ (self):
-        return hash((self.name, self.target))
+        return self._hash
 
     def __ge__ (self, obj):
         return ((self.name, self.target) >= (obj.name, obj.target))
@@ -2953,13 +3478,13 @@ class Action (object):
             return 'acc'
         if self.name == ActionName.ERROR:
             return 'err'
-        name = ActionName(self.name).name[:1]
+        c = _ACTION_CHARS[self.name]
         if self.name == ActionName.REDUCE:
-            return name + '/' + str(self.target) + '(%s)'%self.rule
-        return name + '/' + str(self.target)
+            return '%s/%d(%s)'%(c, self.target, self.rule)
+        return '%s/%d'%(c, self.target)
 
     def __repr__ (self):
-        return '%s(%r, %r)'%(type(self).__name__, self.mode, self.target)
+        return '%s(%r, %r)'%(type(self).__name__, self.name, self.target)
 
 
 #----------------------------------------------------------------------
@@ -3007,10 +3532,16 @@ tab[11]["L"] = [Action(Action.Shift, 10)]
 '''
 class LRTable (object):
 
+    # save() 的格式版本, 存盘格式或者状态编号、产生式展开的方式变了就加一
+    VERSION = 3
+
     def __init__ (self, head:list[Symbol]):
         self.head = self.__build_head(head)     # all non-terminals and terminals
         self.rows = []
-        self.mode = 0   # mode 0 is set, mode 1 is list
+        # mode 0: 单元格没有冲突时直接存 Action，有冲突时才升级成 set
+        # mode 1: 单元格总是 list
+        self.mode = 0
+        self._actions = {}      # (name, target, id(rule)) -> Action, 见 action()
 
     def __build_head (self, head):
         terminal = []
@@ -3043,8 +3574,88 @@ class LRTable (object):
 
     def clear (self):
         self.rows.clear()
+        self._actions.clear()
         return 0
 
+    # 同一张表里动作、目标和产生式都相同的 Action 只创建一个，
+    # 大量单元格共享同一个归约动作, add() 里的比较也多半是同一个对象
+    def action (self, name: int, target: int, rule: Production = None) -> Action:
+        key = (name, target, id(rule))
+        action = self._actions.get(key)
+        if action is None:
+            action = Action(name, target, rule)
+            self._actions[key] = action
+        return action
+
+    # 分析表存盘: Action 存成 (name, target, 产生式编号), 不保存状态集合,
+    # 先写临时文件再改名, 其他进程不会读到写了一半的文件;
+    # 只写 Python 字面量, 不用 pickle, 读入时不会执行文件里的代码
+    def save (self, filename: str, fingerprint: str):
+        def dump (action):
+            rule = action.rule
+            return (int(action.name), action.target, -1 if rule is None else rule.index)
+        rows = []
+        for row in self.rows:
+            rr = {}
+            for col, cell in row.items():
+                if isinstance(cell, Action):
+                    rr[col] = dump(cell)
+                elif isinstance(cell, list):
+                    rr[col] = [dump(a) for a in cell]
+                else:
+                    rr[col] = set([dump(a) for a in cell])
+            rows.append(rr)
+        data = {'version': LRTable.VERSION, 'fingerprint': fingerprint,
+                'mode': self.mode, 'rows': rows}
+        temp = filename + '.%d.tmp'%os.getpid()
+        try:
+            with open(temp, 'w', encoding = 'utf-8') as fp:
+                fp.write(repr(data))
+            os.replace(temp, filename)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+        return 0
+
+    # 读入 save() 保存的数据, 文件不存在、损坏、不是纯字面量
+    # 或者指纹不一致时返回 None
+    @staticmethod
+    def load (filename: str, fingerprint: str):
+        try:
+            with open(filename, 'r', encoding = 'utf-8') as fp:
+                data = ast.literal_eval(fp.read())
+        except Exception:
+            return None
+        if not isinstance(data, dict) or data.get('version') != LRTable.VERSION:
+            return None
+        if data.get('fingerprint') != fingerprint:
+            return None
+        if not isinstance(data.get('rows'), list):
+            return None
+        return data
+
+    # 用 load() 读到的数据重建分析表, g 必须已经增广过
+    @staticmethod
+    def restore (g: Grammar, data: dict):
+        tab = LRTable(list(g.symbol.values()))
+        tab.mode = data['mode']
+        production = g.production
+        def make (item):
+            name, target, index = item
+            rule = None if index < 0 else production[index]
+            return tab.action(ActionName(name), target, rule)
+        for row in data['rows']:
+            rr = {}
+            for col, cell in row.items():
+                if isinstance(cell, tuple):
+                    rr[col] = make(cell)
+                elif isinstance(cell, list):
+                    rr[col] = [make(n) for n in cell]
+                else:
+                    rr[col] = set([make(n) for n in cell])
+            tab.rows.append(rr)
+        return tab
+
     def get (self, row, col):
         if row not in self.rows:
             return None
@@ -3058,7 +3669,7 @@ class LRTable (object):
                 self.rows.append({})
         rr = self.rows[row]
         if self.mode == 0:
-            rr[col] = set([data])
+            rr[col] = data
         else:
             rr[col] = [data]
         return 0
@@ -3072,15 +3683,29 @@ class LRTable (object):
                 self.rows.append({})
         rr = self.rows[row]
         if self.mode == 0:
-            if col not in rr:
-                rr[col] = set([])
-            rr[col].add(data)
+            cell = rr.get(col)
+            if cell is None:
+                rr[col] = data
+            elif isinstance(cell, Action):
+                if cell is not data and cell != data:
+                    rr[col] = set([cell, data])
+            else:
+                cell.add(data)
         else:
             if col not in rr:
                 rr[col] = []
             rr[col].append(data)
         return 0
 
+    # 单元格里的所有动作: 单个 Action 或者 set/list
+    @staticmethod
+    def cell_actions (cell):
+        if cell is None:
+            return ()
+        elif isinstance(cell, Action):
+            return (cell,)
+        return cell
+
     def print (self):
         rows = []
         head = ['STATE'] + [str(n) for n in self.head]
@@ -3092,7 +3717,7 @@ class LRTable (object):
                 if col not in row:
                     body.append('')
                 else:
-                    p = row[col]
+                    p = LRTable.cell_actions(row[col])
                     text = ','.join([str(x) for x in p])
                     body.append(text)
             rows.append(body)
@@ -3101,6 +3726,43 @@ class LRTable (object):
         return rows
 
 
+#----------------------------------------------------------------------
+# LRLazyRows: 按需展开的分析表行, 见 LR1Analyzer.process(lazy = True)
+#----------------------------------------------------------------------
+class LRLazyRows (list):
+
+    # 还没展开的行是 None, 第一次访问时调用 expand(row) 生成
+    def __init__ (self, expand):
+        super(LRLazyRows, self).__init__()
+        self.expand = expand
+        self.solve = None       # 新展开的行交给 solve(row, cells) 解决冲突
+
+    def __getitem__ (self, index):
+        cells = list.__getitem__(self, index)
+        if cells is None:
+            if index < 0:
+                index += len(self)
+            cells = self.expand(index)
+            if self.solve is not None:
+                self.solve(index, cells)
+        return cells
+
+    # 遍历整张表时全部展开，展开的过程中还会追加新的行
+    def __iter__ (self):
+        index = 0
+        while index < len(self):
+            yield self[index]
+            index += 1
+
+    # 已经展开的行: [(row, cells) ...]
+    def expanded (self):
+        output = []
+        for index, cells in enumerate(list.__iter__(self)):
+            if cells is not None:
+                output.append((index, cells))
+        return output
+
+
 #----------------------------------------------------------------------
 # Node
 #----------------------------------------------------------------------
@@ -3140,14 +3802,22 @@ class LR1Analyzer (object):
         self.ga = GrammarAnalyzer(self.g)
         self.verbose = 2
         self.state = {}         # state by uuid
-        self.names = {}         # state by name
+        self.names = {}         # state by kernel key
         self.link = {}          # state switch
         self.backlink = {}      #
         self.tab = None         # LR table
         self.pending = collections.deque()  # BFS state deque
-
-    def process (self):
+        self._lookahead = {}    # FIRST 位集合 -> 向前看符号 tuple
+        self._items = {}        # (非终结符, FIRST 位集合) -> closure 生成的项目列表
+        self._expand = {}       # 项目编号 -> 该项目在 closure 中展开出的项目列表
+        self._closures = {}     # 内核项展开出的项目列表序列 -> 非内核项列表
+        self.lazy = False       # 按需展开状态, 见 expand()
+
+    # lazy 为 True 时只生成初始状态，分析表的行在第一次访问时才展开，
+    # 适合只分析少量输入的场合；遍历整张表 (打印, 解决冲突) 时会全部展开
+    def process (self, lazy = False):
         self.clear()
+        self.lazy = False
         self.ga.process()
         error = self.ga.check_grammar()
         if error > 0:
@@ -3156,6 +3826,11 @@ class LR1Analyzer (object):
             return 2
         if 'S^' not in self.g.symbol:
             self.g.augment()
+        if lazy:
+            hr = self.__build_lazy()
+            if hr != 0:
+                return 3
+            return 0
         hr = self.__build_states()
         if hr != 0:
             return 3
@@ -3169,25 +3844,33 @@ class LR1Analyzer (object):
 
     def __contains__ (self, key):
         if isinstance(key, LRItemSet):
-            return (key.name in self.names)
+            return (key.key in self.names)
         elif isinstance(key, str):
-            return (key in self.names)
+            return (self.__find_name(key) is not None)
         elif not hasattr(key, '__iter__'):
             raise TypeError('invalid type')
-        name = LRItemSet.create_name(key)
-        return (name in self.names)
+        return (LRItemSet.create_key(key) in self.names)
 
     def __getitem__ (self, key):
         if isinstance(key, int):
             return self.state[key]
         elif isinstance(key, str):
-            return self.names[key]
+            state = self.__find_name(key)
+            if state is None:
+                raise KeyError(key)
+            return state
         elif isinstance(key, LRItemSet):
-            return self.names[key.name]
+            return self.names[key.key]
         elif not hasattr(key, '__iter__'):
             raise TypeError('invalid type')
-        name = LRItemSet.create_name(key)
-        return self.names[name]
+        return self.names[LRItemSet.create_key(key)]
+
+    # 按可读状态名查找，只有调试时才用得到
+    def __find_name (self, name):
+        for state in self.state.values():
+            if state.name == name:
+                return state
+        return None
 
     def __iter__ (self):
         return self.state.__iter__()
@@ -3197,8 +3880,12 @@ class LR1Analyzer (object):
             raise KeyError('conflict key')
         state.uuid = len(self.state)
         self.state[state.uuid] = state
-        self.names[state.name] = state
-        self.pending.append(state)
+        self.names[state.key] = state
+        if self.lazy:
+            # 还没展开的状态先占一行
+            self.tab.rows.append(None)
+        else:
+            self.pending.append(state)
         return 0
 
     def clear (self):
@@ -3207,8 +3894,19 @@ class LR1Analyzer (object):
         self.link.clear()
         self.backlink.clear()
         self.pending.clear()
+        self._lookahead.clear()
+        self._items.clear()
+        self._expand.clear()
+        self._closures.clear()
         return 0
 
+    # 展开 closure 用的产生式列表，按符号编号查 GrammarAnalyzer.rules_by_nt
+    def _closure_rules (self, name):
+        sid = self.g.sym_id.get(name)
+        if sid is None:
+            return None
+        return self.ga.rules_by_nt[sid]
+
     """
     # https://mmmhj2.github.io/%E7%BC%96%E8%AF%91%E5%8E%9F%E7%90%86/2023/01/11/syntax-analysis-bottomup-CLR.html
     # https://www.cnblogs.com/cyjb/p/ParserLALR.html
@@ -3241,65 +3939,100 @@ class LR1Analyzer (object):
         # (这里 a 是向前看符号，显然要求下一个输入是 a 时才能归约），那我们再向前倒推到按照 B -> γ 归约前，就会有 ...α B β a = ...α γ β a,
         # 就可以看到只有 γ 后跟 βa 时, 才有可能按照 B -> γ 归约，即 B -> γ 的向前看符号在 FIRST(βa) 之中。
     """
+    # B 的产生式在 closure 中生成的项目 [B -> . γ, b], b 取自 FIRST(βa) 位集合,
+    # 只和 (B, 位集合) 有关, 所有状态共用; bits 为 None 时生成 LR(0) 项目
+    def _closure_items (self, name, bits = None):
+        key = (name, bits)
+        items = self._items.get(key)
+        if items is not None:
+            return items
+        rules = self._closure_rules(name)
+        if rules is None:
+            LOG_ERROR('no production rules for symbol %s'%name)
+            raise GrammarError('no production rules for symbol %s'%name)
+        if bits is None:
+            items = [RulePtr.intern(rule, 0) for rule in rules]
+        else:
+            first = self._lookahead_symbols(bits)
+            if DEBUG:
+                LOG_DEBUG('first:', first)
+            items = [RulePtr.intern(rule, 0, term) for rule in rules for term in first]
+        self._items[key] = items
+        return items
+
+    # FIRST 位集合 -> 向前看符号 tuple, 同一个位集合共享同一个 tuple
+    def _lookahead_symbols (self, bits):
+        first = self._lookahead.get(bits)
+        if first is None:
+            first = self.ga.bits_to_set(bits)
+            first = tuple([_intern_symbol(n, n != '') for n in first])
+            self._lookahead[bits] = first
+        return first
+
+    # 项目 A 在 closure 中直接展开出的项目
+    def _expand_item (self, A:RulePtr):
+        B: Symbol = A._next
+        if B is None or B.term:
+            return ()
+        # next A is non-terminal
+        if DEBUG:
+            LOG_DEBUG('CLOSURE iteration')
+            LOG_DEBUG(f'A={A} B={B}')
+        # FIRST(β a): β 可以推出 epsilon 时才并上 a
+        bits = self.ga.suffix_first_bits(A.rule, A.index + 1)
+        if A.lookahead is not None and bits & EPSILON_BIT:
+            bits = (bits & ~EPSILON_BIT) | self.ga.vector_first_bits((A.lookahead,))
+        if DEBUG:
+            LOG_DEBUG('after:', A.after_list(1), A.lookahead)
+        return self._closure_items(B.name, bits)
+
     # 扩充 LRItemSet，不产生新的 LRItemSet
+    # 每个项目展开出的项目只算一次，按项目编号缓存，展开顺序和逐项计算时一致
     def closure (self, cc:LRItemSet) -> LRItemSet:
         cc.clear()
         for n in cc.kernel:
-            if n.name not in cc:
+            if n not in cc:
                 cc.append(n)
-        if 1:
+        if DEBUG:
             LOG_DEBUG('')
             LOG_DEBUG('-' * 72)
             LOG_DEBUG('CLOSURE init')
-        top = 0
-        '''
-        while 1:
-            changes = 0
-            ....
-            if not changes:
-                break
-
-        similarly:
-            do while
-        '''
-        while 1:
-            changes = 0
-            limit = len(cc.closure)
-            # for A in cc.closure:
-            while top < limit:
-                A: RulePtr = cc.closure[top]
-                top += 1
-                B: Symbol = A.next
-                if B is None:
-                    continue
-                if B.term:
-                    continue
-                # next A is non-terminal
-                if B.name not in self.g.rule:
-                    LOG_ERROR('no production rules for symbol %s'%B.name)
-                    raise GrammarError('no production rules for symbol %s'%B.name)
-                if 1:
-                    LOG_DEBUG('CLOSURE iteration') 
-                    LOG_DEBUG(f'A={A} B={B}')
-                after = A.after_list(1)
-                if A.lookahead is not None:
-                    after.append(A.lookahead)
-                first = self.ga.vector_first_set(after)
-                first = [load_symbol(n) for n in first]
-                for f in first:
-                    if f.name != '':
-                        f.term = True
-                if 1:
-                    LOG_DEBUG('after:', after)
-                    LOG_DEBUG('first:', first)
-                for rule in self.g.rule[B.name]:
-                    for term in first:
-                        rp = RulePtr(rule, 0, term)
-                        if rp.name not in cc:
-                            cc.append(rp)
-                            changes += 1
-            if changes == 0:
-                break
+        # 热点循环: 方法和容器都先取到局部变量里
+        expand = self._expand
+        expand_get = expand.get
+        checked = cc.checked_ids
+        checked_add = checked.add
+        closure = cc.closure
+        closure_append = closure.append
+        # 非内核项 (圆点在最左边) 不会和内核项重复, 它们的顺序只由各内核项
+        # 展开出的项目列表决定, 这些列表都缓存在 _items 里, 用它们的 id 做键
+        sig = []
+        for A in closure:
+            items = expand_get(A.uid)
+            if items is None:
+                items = self._expand_item(A)
+                expand[A.uid] = items
+            if items:
+                sig.append(id(items))
+        sig = tuple(sig)
+        items = self._closures.get(sig)
+        if items is not None:
+            closure.extend(items)
+            checked.update([rp.uid for rp in items])
+            return cc
+        size = len(closure)
+        for A in closure:
+            # 遍历的同时在末尾追加, 新项目也会被访问到
+            items = expand_get(A.uid)
+            if items is None:
+                items = self._expand_item(A)
+                expand[A.uid] = items
+            for rp in items:
+                uid = rp.uid
+                if uid not in checked:
+                    checked_add(uid)
+                    closure_append(rp)
+        self._closures[sig] = closure[size:]
         return cc
 
     """
@@ -3317,18 +4050,7 @@ class LR1Analyzer (object):
         return goto
     """
     def goto (self, cc:LRItemSet, X:Symbol) -> LRItemSet:
-        kernel = []
-        for rp in cc:
-            if rp.next is None:
-                continue
-            if rp.next.name != X.name:
-                continue
-            # if next is Symbol X
-            # np: next RulePtr
-            np = rp.advance()
-            if np is None:
-                continue
-            kernel.append(np)
+        kernel = cc.goto_kernel(X)
         if not kernel:
             return None
         # 内核项
@@ -3336,22 +4058,6 @@ class LR1Analyzer (object):
         # 对内核项求 closure，传播和自发生成非内核项，项集中加入非内核项
         return self.closure(nc)
 
-    # 只产生内核项，不求 closure
-    def __try_goto (self, cc:LRItemSet, X:Symbol):
-        kernel = []
-        for rp in cc:
-            if rp.next is None:
-                continue
-            if rp.next.name != X.name:
-                continue
-            np = rp.advance()
-            if np is None:
-                continue
-            kernel.append(np)
-        if not kernel:
-            return None
-        return kernel
-
     def __build_states (self):
         self.clear()
         g = self.g
@@ -3360,10 +4066,12 @@ class LR1Analyzer (object):
         assert g.start.name in g.rule
         assert len(g.rule[g.start.name]) == 1
         rule = self.g.rule[g.start.name][0]
-        rp = RulePtr(rule, 0, EOF)
+        rp = RulePtr.intern(rule, 0, EOF)
         state = LRItemSet([rp])
         self.closure(state)
         self.append(state)
+        pending = self.pending
+        update_state = self.__update_state
         while 1:
             if 0:
                 changes = 0
@@ -3373,27 +4081,53 @@ class LR1Analyzer (object):
                     break
             else:
                 # BFS
-                if len(self.pending) == 0:
+                if not pending:
                     break
-                state = self.pending.popleft()
-                self.__update_state(state)
+                update_state(pending.popleft())
+        return 0
+
+    # 只生成初始状态的内核项，其他状态由 expand() 按需生成
+    def __build_lazy (self):
+        self.clear()
+        g = self.g
+        assert g.start is not None
+        assert g.start.name == 'S^'
+        assert g.start.name in g.rule
+        assert len(g.rule[g.start.name]) == 1
+        heading = [n for n in self.g.symbol.values()]
+        self.tab = LRTable(heading)
+        self.tab.rows = LRLazyRows(self.expand)
+        self.lazy = True
+        rule = self.g.rule[g.start.name][0]
+        rp = RulePtr.intern(rule, 0, EOF)
+        self.append(LRItemSet([rp]))
         return 0
 
+    # 展开状态: 求 closure, 生成 goto 的内核项 (新状态只有内核项), 填写分析表的一行
+    def expand (self, uuid):
+        state = self.state[uuid]
+        LOG_VERBOSE('expand state', uuid)
+        if not state.closure:
+            self.closure(state)
+        self.__update_state(state)
+        tab: LRTable = self.tab
+        row = {}
+        tab.rows[uuid] = row
+        self._build_row(tab, state)
+        return row
+
     def __update_state (self, cc:LRItemSet):
         changes = 0
-        for symbol in cc.find_expecting_symbol():
+        for symbol, kernel_list in cc.goto_kernels():
             # print('expecting', symbol)
-            kernel_list = self.__try_goto(cc, symbol)
-            if not kernel_list:
-                continue
-            name = LRItemSet.create_name(kernel_list)
-            if name in self:
-                ns = self.names[name]
+            ns = self.names.get(LRItemSet.create_key(kernel_list))
+            if ns is not None:
                 self.__create_link(cc, ns, symbol)
                 continue
-            LOG_VERBOSE('create state %d'%len(self.state))
+            LOG_VERBOSE('create state', len(self.state))
             ns = LRItemSet(kernel_list)
-            self.closure(ns)
+            if not self.lazy:
+                self.closure(ns)
             self.append(ns)
             self.__create_link(cc, ns, symbol)
             # print(ns.name)
@@ -3407,17 +4141,16 @@ class LR1Analyzer (object):
         assert c2 is not None
         assert c1.uuid >= 0
         assert c2.uuid >= 0
-        if c1.uuid not in self.link:
-            self.link[c1.uuid] = {}
-        if ss.name not in self.link[c1.uuid]:
-            self.link[c1.uuid][ss.name] = c2.uuid
-        else:
-            if self.link[c1.uuid][ss.name] != c2.uuid:
-                LOG_ERROR('conflict states')
-        if c2.uuid not in self.backlink:
-            self.backlink[c2.uuid] = {}
-        if ss.name not in self.backlink[c2.uuid]:
-            self.backlink[c2.uuid][ss.name] = c1.uuid
+        # 每条边只查一次行和一次列, 已经存在时 setdefault 返回原来的目标
+        row = self.link.get(c1.uuid)
+        if row is None:
+            row = self.link[c1.uuid] = {}
+        if row.setdefault(ss.name, c2.uuid) != c2.uuid:
+            LOG_ERROR('conflict states')
+        row = self.backlink.get(c2.uuid)
+        if row is None:
+            row = self.backlink[c2.uuid] = {}
+        row.setdefault(ss.name, c1.uuid)
         return 0
 
     def __build_table (self):
@@ -3429,42 +4162,148 @@ class LR1Analyzer (object):
             import pprint
             pprint.pprint(self.link)
         for state in self.state.values():
-            uuid = state.uuid
-            link = self.link.get(uuid, None)
-            LOG_VERBOSE(f'build table for I{state.uuid}')
-            # LOG_VERBOSE(
-            for rp in state.closure:
-                rp: RulePtr = rp
-                # dot is at rightmost production
-                if rp.satisfied:
-                    LOG_VERBOSE("  satisfied:", rp)
-                    if rp.rule.head.name == 'S^':
-                        if len(rp.rule.body) == 1:
-                            # 增广产生式的 body 只有一个, S^ -> S
-                            action = Action(ActionName.ACCEPT, 0)
-                            action.rule = rp.rule
-                            tab.add(uuid, rp.lookahead.name, action)
-                        else:
-                            LOG_ERROR('error accept:', rp)
-                    else:
-                        action = Action(ActionName.REDUCE, rp.rule.index)
-                        action.rule = rp.rule
+            self._build_row(tab, state)
+        return 0
+
+    # 填写状态 state 对应的一行
+    def _build_row (self, tab:LRTable, state:LRItemSet):
+        uuid = state.uuid
+        link = self.link.get(uuid, None)
+        LOG_VERBOSE('build table for state', state.uuid)
+        # LOG_VERBOSE(
+        for rp in state.closure:
+            rp: RulePtr = rp
+            # dot is at rightmost production
+            if rp._satisfied:
+                LOG_VERBOSE("  satisfied:", rp)
+                if rp.rule.head.name == 'S^':
+                    if len(rp.rule.body) == 1:
+                        # 增广产生式的 body 只有一个, S^ -> S
+                        action = tab.action(ActionName.ACCEPT, 0, rp.rule)
                         tab.add(uuid, rp.lookahead.name, action)
-                # include ACTION and GOTO table
-                # ACTION[i, a] = sj ; current state i, terminal a, shift s, next state j
-                # GOTO[i, a] = j ; current state i, non-terminal a, next state j
-                elif rp.next.name in link:
-                    target = link[rp.next.name]
-                    action = Action(ActionName.SHIFT, target, rp.rule)
-                    tab.add(uuid, rp.next.name, action)
+                    else:
+                        LOG_ERROR('error accept:', rp)
                 else:
+                    action = tab.action(ActionName.REDUCE, rp.rule.index, rp.rule)
+                    tab.add(uuid, rp.lookahead.name, action)
+            # include ACTION and GOTO table
+            # ACTION[i, a] = sj ; current state i, terminal a, shift s, next state j
+            # GOTO[i, a] = j ; current state i, non-terminal a, next state j
+            else:
+                target = link.get(rp._next_name)
+                if target is None:
                     LOG_ERROR('error link')
+                    continue
+                action = tab.action(ActionName.SHIFT, target, rp.rule)
+                tab.add(uuid, rp._next_name, action)
         return 0
 
     def build_LR1_table (self) -> LRTable:
         self.__build_table()
         return self.tab
 
+    # 表格压缩: 合并内核核心 (不看 lookahead) 相同、且动作兼容的状态。
+    # 兼容指两个状态在同一列上都有动作时动作完全相同 (移进目标按合并后的状态比较),
+    # 因此合并不会引入新的冲突; 合并后可能使原来目标不同的状态变得兼容, 反复合并到不变为止。
+    # 只有规范 LR(1) 会有核心相同的状态, 合并后报错可能推迟 (和 LALR 一样), 所以需要显式调用
+    def merge_states (self) -> int:
+        tab: LRTable = self.tab
+        if tab is None or len(self.state) == 0:
+            return 0
+        while len(tab.rows) < len(self.state):
+            tab.rows.append({})
+        rows = tab.rows
+        parent = list(range(len(self.state)))
+        def find (x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+        def signature (cell):
+            actions = LRTable.cell_actions(cell)
+            return frozenset([(a.name, find(a.target) if a.name == ActionName.SHIFT else a.target) for a in actions])
+        def compatible (r1, r2):
+            for col, cell in r2.items():
+                other = r1.get(col)
+                if other is not None and signature(other) != signature(cell):
+                    return False
+            return True
+        groups = {}
+        for uuid, state in self.state.items():
+            core = set([RulePtr.intern(rp.rule, rp.index).uid for rp in state.kernel])
+            groups.setdefault(tuple(sorted(core)), []).append(uuid)
+        groups = [n for n in groups.values() if len(n) > 1]
+        merged = 0
+        while 1:
+            changes = 0
+            for group in groups:
+                for i, u1 in enumerate(group):
+                    if find(u1) != u1:
+                        continue
+                    for u2 in group[i + 1:]:
+                        if find(u2) != u2:
+                            continue
+                        if not compatible(rows[u1], rows[u2]):
+                            continue
+                        for col, cell in rows[u2].items():
+                            if col not in rows[u1]:
+                                rows[u1][col] = cell
+                        parent[u2] = u1
+                        changes += 1
+            if changes == 0:
+                break
+            merged += changes
+        if merged == 0:
+            return 0
+        # 重新编号, 保留每组里编号最小的状态
+        alive = [uuid for uuid in range(len(self.state)) if find(uuid) == uuid]
+        remap = {}
+        for i, uuid in enumerate(alive):
+            remap[uuid] = i
+        for uuid in range(len(self.state)):
+            remap[uuid] = remap[find(uuid)]
+        members = {}
+        for uuid in range(len(self.state)):
+            members.setdefault(remap[uuid], []).append(self.state[uuid])
+        tab.rows = []
+        for uuid in alive:
+            row = {}
+            for col, cell in rows[uuid].items():
+                actions = []
+                for a in LRTable.cell_actions(cell):
+                    if a.name == ActionName.SHIFT:
+                        a = tab.action(ActionName.SHIFT, remap[a.target], a.rule)
+                    actions.append(a)
+                if isinstance(cell, Action):
+                    row[col] = actions[0]
+                else:
+                    row[col] = type(cell)(actions)
+            tab.rows.append(row)
+        link = self.link
+        names = self.names
+        self.state = {}
+        self.link = {}
+        self.backlink = {}
+        for uuid in alive:
+            group = members[remap[uuid]]
+            if len(group) == 1:
+                state = group[0]
+            else:
+                kernel = []
+                for n in group:
+                    kernel.extend(n.kernel)
+                state = LRItemSet(kernel)
+                self.closure(state)
+            state.uuid = remap[uuid]
+            self.state[state.uuid] = state
+            names[state.key] = state
+            for n in group:
+                names[n.key] = state
+        for uuid in alive:
+            for name, target in link.get(uuid, {}).items():
+                self.__create_link(self.state[remap[uuid]], self.state[remap[target]], self.g.symbol[name])
+        return merged
+
     def build_table (self) -> LRTable:
         return self.__build_table()
 
@@ -3486,20 +4325,29 @@ class LALRItemSet (LRItemSet):
 
     def __init__ (self, kernel_source):
         super(LALRItemSet, self).__init__(kernel_source)
-        self.lookahead = [set([]) for n in range(len(self.kernel))] # set
+        # 传播时只用位集合, 传播结束后才解码成向前看符号 (共享的 tuple)
+        self.lookahead = [() for n in range(len(self.kernel))]
+        self.lookahead_bits = [0] * len(self.kernel)
         self.dirty = False  # dirty is True if ItemSet modified
+        self.position = None    # 不带 lookahead 的内核项 -> 内核项下标
 
     def shrink (self):
         while len(self.closure) > len(self.kernel):
             self.closure.pop()
         return 0
 
+    # 内核项在 kernel 中的下标，找不到返回 -1
+    def kernel_index (self, item: RulePtr) -> int:
+        if self.position is None:
+            self.position = {k: i for i, k in enumerate(self.kernel)}
+        return self.position.get(item, -1)
+
     def print (self):
         rows = []
         print('STATE(%d): %s'%(self.uuid, self.name))
         for i, rp in enumerate(self.closure):
             if i < len(self.kernel):
-                p = ' ' .join([str(n) for n in self.lookahead[i]])
+                p = ' ' .join([str(n) for n in set(self.lookahead[i])])
                 p = '{' + p + '}'
                 t = '(K)'   # kernel
             else:
@@ -3680,40 +4528,51 @@ class LALRAnalyzer (object):
         self.ga: GrammarAnalyzer = GrammarAnalyzer(self.g)
         self.la: LR1Analyzer = LR1Analyzer(self.g)
         self.state = {}         # state by uuid
-        self.names = {}         # state by name
+        self.names = {}         # state by kernel key
         self.link = {}          # state switch
         self.backlink = {}      #
-        self.route = {}
         self.pending = collections.deque()
-        self.dirty = set([])
-        self.cache = {}
+        # LALR-by-SLR 的扩展文法, 见 __build_propagate_route()
+        self.nodes = {}         # (state uuid, 非终结符) -> 扩展非终结符编号
+        self.follow = []        # 扩展非终结符 -> FOLLOW 位集合
+        self.route = []         # 扩展非终结符 -> FOLLOW 要传播到的扩展非终结符
+        self.reach = []         # 扩展非终结符 -> FOLLOW 要加到的 (state uuid, 内核项下标)
+        self.nt_closure = {}    # 非终结符 -> 传递闭包的 LR(0) 项目列表
+        self.walks = {}         # 产生式编号 -> 沿右部的每一步, 见 __rule_walk()
+        self.cache = {}         # 内核的非终结符序列 -> 非内核项目列表
 
     def __len__ (self):
         return len(self.state)
 
     def __contains__ (self, key):
         if isinstance(key, LALRItemSet):
-            return (key.name in self.names)
+            return (key.key in self.names)
         elif isinstance(key, str):
-            return (key in self.names)
+            return (self.__find_name(key) is not None)
         elif not hasattr(key, '__iter__'):
             raise TypeError('invalid type')
-        name = LRItemSet.create_name(key)
-        return (name in self.names)
+        return (LRItemSet.create_key(key) in self.names)
 
     def __getitem__ (self, key):
         if isinstance(key, int):
             return self.state[key]
         elif isinstance(key, str):
-            return self.names[key]
+            state = self.__find_name(key)
+            if state is None:
+                raise KeyError(key)
+            return state
         elif isinstance(key, LRItemSet):
-            return self.names[key.name]
-        elif isinstance(key, LALRItemSet):
-            return self.names[key.name]
+            return self.names[key.key]
         elif not hasattr(key, '__iter__'):
             raise TypeError('invalid type')
-        name = LRItemSet.create_name(key)
-        return self.names[name]
+        return self.names[LRItemSet.create_key(key)]
+
+    # 按可读状态名查找，只有调试时才用得到
+    def __find_name (self, name):
+        for state in self.state.values():
+            if state.name == name:
+                return state
+        return None
 
     def __iter__ (self):
         return self.state.__iter__()
@@ -3723,7 +4582,7 @@ class LALRAnalyzer (object):
             raise KeyError('conflict key')
         state.uuid = len(self.state)
         self.state[state.uuid] = state
-        self.names[state.name] = state
+        self.names[state.key] = state
         self.pending.append(state)
         return 0
 
@@ -3733,7 +4592,12 @@ class LALRAnalyzer (object):
         self.link.clear()
         self.backlink.clear()
         self.pending.clear()
-        self.route.clear()
+        self.nodes.clear()
+        self.follow = []
+        self.route = []
+        self.reach = []
+        self.nt_closure.clear()
+        self.walks.clear()
         self.cache.clear()
         return 0
 
@@ -3760,65 +4624,66 @@ class LALRAnalyzer (object):
         self.tab = self.la.build_LR1_table()
         return 0
 
+    # 非内核项 (圆点在最左边) 不会和内核项重复, 它们的顺序只由内核项圆点后的
+    # 非终结符序列决定, 以这个序列为键缓存非内核项列表
+    # 从 closure[top:] 开始按广度优先把非终结符的产生式加进来,
+    # LR(0) 项目和 LR1Analyzer 共用缓存
+    def __expand_closure (self, closure, checked, top):
+        closure_items = self.la._closure_items
+        while top < len(closure):
+            A: RulePtr = closure[top]
+            top += 1
+            B = A._next
+            if B is None:
+                continue
+            if B.term:
+                continue
+            for li in closure_items(B.name):
+                if li.uid not in checked:
+                    checked.add(li.uid)
+                    closure.append(li)
+        return closure
+
+    # 非终结符 name 的传递闭包: name 的全部产生式以及由它们
+    # 展开出的项目, 第一次用到时算好, 顺序和广度优先展开一致
+    def _nt_closure (self, name):
+        items = self.nt_closure.get(name)
+        if items is None:
+            items = list(self.la._closure_items(name))
+            checked = set([li.uid for li in items])
+            self.__expand_closure(items, checked, 0)
+            self.nt_closure[name] = items
+        return items
+
     def _LR0_closure (self, cc:LALRItemSet):
         cc.clear()
         for k in cc.kernel:
             cc.append(k)
-        top = 0
-        while 1:
-            changes = 0
-            limit = len(cc)
-            while top < limit:
-                A: RulePtr = cc.closure[top]
-                top += 1
-                B = A.next
-                if B is None:
-                    continue
-                if B.term:
-                    continue
-                # next A is non-terminal
-                if B.name not in self.g.rule:
-                    LOG_ERROR('no production rules for symbol %s'%B.name)
-                for rule in self.g.rule[B.name]:
-                    li = RulePtr(rule, 0, None)
-                    if li not in cc:
-                        cc.append(li)
-                        changes += 1
-            if not changes:
-                break
+        checked = cc.checked_ids
+        closure = cc.closure
+        # 非内核项只取决于内核点号后的非终结符, 重复的只算第一次
+        names = [k._next_name for k in cc.kernel if k._next is not None and not k._next.term]
+        sig = tuple(dict.fromkeys(names))
+        if len(sig) == 1:
+            # 只有一个非终结符时闭包就是它的传递闭包
+            items = self._nt_closure(sig[0])
+        else:
+            items = self.cache.get(sig)
+        if items is not None:
+            closure.extend(items)
+            checked.update([li.uid for li in items])
+            return cc
+        self.__expand_closure(closure, checked, 0)
+        self.cache[sig] = closure[len(cc.kernel):]
         return cc
 
     def _LR0_goto (self, cc:LALRItemSet, X:Symbol):
-        kernel = []
-        for li in cc:
-            if li.next is None:
-                continue
-            if li.next.name != X.name:
-                continue
-            np = li.advance()
-            if np is None:
-                continue
-            kernel.append(np)
+        kernel = cc.goto_kernel(X)
         if not kernel:
             return None
         nc = LALRItemSet(kernel)
         return self._LR0_closure(nc)
 
-    def __LR0_try_goto (self, cc:LALRItemSet, X:Symbol):
-        kernel = []
-        for lp in cc:
-            if lp.next is None:
-                continue
-            if lp.next.name != X.name:
-                continue
-            np = lp.advance()
-            if np is None:
-                continue
-            kernel.append(np)
-        if not kernel:
-            return None
-        return kernel
-
     def __LR0_build_states (self):
         self.clear()
         g = self.g
@@ -3827,7 +4692,7 @@ class LALRAnalyzer (object):
         assert g.start.name in g.rule
         assert len(g.rule[g.start.name]) == 1
         rule = self.g.rule[g.start.name][0]
-        lp = RulePtr(rule, 0)
+        lp = RulePtr.intern(rule, 0)
         state = LALRItemSet([lp])   # 实际上是 LR0 项集，构造 LR0 项集不带 lookahead
         self._LR0_closure(state)
         self.append(state)
@@ -3841,17 +4706,13 @@ class LALRAnalyzer (object):
 
     def __LR0_update_state (self, cc:LALRItemSet):
         changes = 0
-        for symbol in cc.find_expecting_symbol():
+        for symbol, kernel_list in cc.goto_kernels():
             # print('expecting', symbol)
-            kernel_list = self.__LR0_try_goto(cc, symbol)
-            if not kernel_list:
-                continue
-            name = LRItemSet.create_name(kernel_list)
-            if name in self:
-                ns = self.names[name]
+            ns = self.names.get(LRItemSet.create_key(kernel_list))
+            if ns is not None:
                 self.__create_link(cc, ns, symbol)
                 continue
-            LOG_VERBOSE('create state %d'%len(self.state))
+            LOG_VERBOSE('create state', len(self.state))
             ns = LALRItemSet(kernel_list)
             self._LR0_closure(ns)
             self.append(ns)
@@ -3865,175 +4726,163 @@ class LALRAnalyzer (object):
         assert c2 is not None
         assert c1.uuid >= 0
         assert c2.uuid >= 0
-        if c1.uuid not in self.link:
-            self.link[c1.uuid] = {}
-        if ss.name not in self.link[c1.uuid]:
-            self.link[c1.uuid][ss.name] = c2.uuid
-        else:
-            if self.link[c1.uuid][ss.name] != c2.uuid:
-                LOG_ERROR('conflict states')
-        if c2.uuid not in self.backlink:
-            self.backlink[c2.uuid] = {}
-        if ss.name not in self.backlink[c2.uuid]:
-            self.backlink[c2.uuid][ss.name] = c1.uuid
+        # 每条边只查一次行和一次列, 已经存在时 setdefault 返回原来的目标
+        row = self.link.get(c1.uuid)
+        if row is None:
+            row = self.link[c1.uuid] = {}
+        if row.setdefault(ss.name, c2.uuid) != c2.uuid:
+            LOG_ERROR('conflict states')
+        row = self.backlink.get(c2.uuid)
+        if row is None:
+            row = self.backlink[c2.uuid] = {}
+        row.setdefault(ss.name, c1.uuid)
         return 0
 
-    def _LR1_create_closure (self, kernel_list) -> LRItemSet:
-        for n in kernel_list:
-            if not isinstance(n, RulePtr):
-                raise TypeError('kernel_list must be a list of RulePtr')
-        cc = LRItemSet(kernel_list)
-        self.la.closure(cc)
-        return cc
-
     '''
-    LALR 项集是可以直接根据 LR (1) 项集合并而来的，但构造 LR (1) 项集族的时间和空间成本都比较高，更实用的是根据 LR (0) 项集族，通过一个 “传播和自发生成” 过程直接生成向前看符号，高效计算 LALR 项的内核。
-        1. 假设项集 I 包含项 [A -> α . β, a], 且 goto(I, X) = J。无论 a 为何值，在 goto(closure([A -> α . β, a]), X) 时得到的结果中总是包含 [B -> γ . δ, b]。那么对于 B -> γ . δ 来说, 向前看符号 b 就是自发生成的。
-        2. 其他条件相同，但有 a = b, 且结果中包含 [B -> γ . δ, b] 的原因是项 A -> α . β 有一个向前看符号 b, 那我们就说向前看符号 b 从 I 的项 A -> α . β 传播到了 J 的项 B -> γ . δ 中。需要注意的是，这里的传播关系与特定向前看符号无关，要么所有向前看符号都从一个项传播到另一个项，要么都不传播。
-
-    找到每个 LR (0) 项集中自发生成的向前看符号，和向前看符号的传播过程，就可以为 LR (0) 项添加上正确的向前看符号了。
-
-    首先需要选择一个不在当前文法中的符号 #，由于它不在文法当中，所以不可能被自发生成。如果计算后的向前看符号是否包含 #，说明向前看符号发生了传播，其它向前看符号就是自发生成的。
-        1. 为当前项集 I 中的每个项 A -> α . β 计算 J = LR1_closure([A -> α . β, #]), 其中 J 中包含一项 [B -> γ . X δ, a/#]。
-        2. 如果 [B -> γ . X δ, a] 在 J 中, 且 a != #, 那么 goto(I, X) 中的项 B -> γ X . δ 的向前看符号 a 时自发生成的。
-        3. 如果 [B -> γ . X δ, #] 在 J 中, 那么向前看符号会从 I 中的项 A -> α . β 传播到 goto(I, X) 中的项 B -> γ X . δ 上。
-
-    伪代码：
-    令 # 为一个不在当前文法中的符号
-    for (LR0 项集 I 的内核项集 K 中的每一个项 A -> α . β) {
-        构造产生式 [A -> α . β, #]
-        J = LR1_closure([A -> α . β, #])
-        for (LR1 项集闭包 J 中的每一项 [B -> γ . X δ, a/#]) {
-            [B -> γ . X δ, a] 向前移进一位 B -> γ X . δ, lookahead = None (存在于 goto(I, X) 项集中)
-            if ([B -> γ . X δ, a] 在 J 中，且 a != #)
-                goto(I, X) 中的项 B -> γ X . δ 的向前看符号 a 时自发生成的。
-                即下一项集的 lookahead 是由上一项集生成而来的。
-            if ([B -> γ . X δ, #] 在 J 中)
-                向前看符号会从 I 中的项 A -> α . β 传播到 goto(I, X) 中的项 B -> γ X . δ 上。
+    LALR 项集是可以直接根据 LR (1) 项集合并而来的，但构造 LR (1) 项集族的时间和空间成本都比较高，更实用的是根据 LR (0) 项集族直接计算向前看符号。
+    这里用 LALR-by-SLR (Bermudez & Logothetis) 的方法，不再为每个内核项求一次带 # 的 LR(1) closure:
+
+    1. 在 LR(0) 自动机上构造扩展文法。状态 p 上非终结符 A 的转移记作 [p, A]，
+       A 的每条产生式 A -> X1 X2 ... Xn 从 p = s0 出发沿 goto 依次经过 s1, s2, ..., sn，
+       得到扩展产生式 [p, A] -> [s0, X1] [s1, X2] ... [sn-1, Xn]。
+    2. 扩展文法中 [p, A] 推导出的串和 A 完全相同，所以 FIRST([p, A]) = FIRST(A)，只需要求扩展文法的 FOLLOW:
+        - Xi 是非终结符时，FIRST(Xi+1 ... Xn) 自发生成到 FOLLOW([si-1, Xi]) 中
+        - Xi+1 ... Xn 能推出 epsilon 时，FOLLOW([p, A]) 传播到 FOLLOW([si-1, Xi])
+       增广产生式 S^ -> S 看作状态 0 上 S^ 的转移，FOLLOW([0, S^]) = {$}。
+    3. 状态 si 中的内核项 A -> X1 ... Xi . Xi+1 ... Xn 的向前看符号，
+       就是所有沿这条产生式走到 si 的 [p, A] 的 FOLLOW 的并集。
+
+    伪代码:
+    for (每个转移 [p, A], A 的每条产生式 A -> X1 ... Xn) {
+        s = p
+        for (i = 1 .. n) {
+            if (Xi 是非终结符) {
+                FOLLOW([s, Xi]) U= FIRST(Xi+1 ... Xn) - {epsilon}
+                if (Xi+1 ... Xn 能推出 epsilon)
+                    FOLLOW([p, A]) 传播到 FOLLOW([s, Xi])
+            }
+            s = goto(s, Xi)
+            FOLLOW([p, A]) 最终加到 s 中内核项 A -> X1 ... Xi . Xi+1 ... Xn 上
         }
     }
-
-    确定了向前看符号的自发生和传播过程，就可以不断在项集间传播向前看符号直到停止。
-        1. 首先，每个项集只包含其自发生成的向前看符号。
-        2. 不断扫描每个项集，确定当前项集 I 可以将向前看符号传播到哪些项集，并将 I 的向前看符号添加到被传播到的项集中。
-        3. 不断重复步骤 2, 直到每个项集的向前看符号都不再增加。
     '''
-    def _LALR_propagate_state (self, state:LALRItemSet) -> int:
-        LOG_VERBOSE('propagate', state.uuid)
-        for key, kernel in enumerate(state.kernel):
-            # 对每个内核项的产生式求 closure
-            rule_ptr = RulePtr(kernel.rule, kernel.index, PSHARP)   # PSHARP is #, # is not in grammar
-            # 对每个内核项产生式构造带有 lookahead 的 LR1 项集闭包
-            closure = self._LR1_create_closure([rule_ptr])
-            for _id, rp in enumerate(closure.closure):
-                # print('RP', rp)
-                expected: Symbol = rp.next
-                if rp.satisfied:
+    def __build_propagate_route (self):
+        g = self.g
+        nodes = self.nodes
+        for state in self.state.values():
+            state.shrink()      # 删除非内核项, 后面只用到内核项
+        # 每个非终结符上的转移是扩展文法的一个非终结符
+        for uuid, link in self.link.items():
+            for name in link:
+                if not g.symbol[name].term:
+                    nodes[(uuid, name)] = len(nodes)
+        start = len(nodes)
+        nodes[(0, 'S^')] = start
+        size = len(nodes)
+        self.follow = [0] * size
+        self.route = [[] for n in range(size)]
+        self.reach = [[] for n in range(size)]
+        self.follow[start] = self.ga.term_bit(EOF.name)
+        # children[node] = [(扩展非终结符, 后缀的 FIRST 位集合, 是否在内核项中) ...]
+        children = [[] for n in range(size)]
+        for (uuid, name), node in nodes.items():
+            if node == start:
+                rules = g.rule[name]
+            else:
+                rules = self.la._closure_rules(name)
+            for rule in rules:
+                self.__build_node_route(node, uuid, rule, children[node])
+        # 后缀的 FIRST 为空且不能推出 epsilon 时 (含有无用符号), closure 里不会
+        # 展开出对应的项目。圆点不在最左边的是内核项, 总会参与计算 (同带 # 的
+        # closure 一样); 圆点在最左边的项目只有 [p, A] 本身被展开过才参与
+        alive = set([start])
+        for node in range(size):
+            for target, bits, kernel in children[node]:
+                if kernel and bits:
+                    alive.add(target)
+        stack = list(alive)
+        while stack:
+            node = stack.pop()
+            for target, bits, kernel in children[node]:
+                if bits and target not in alive:
+                    alive.add(target)
+                    stack.append(target)
+        follow = self.follow
+        for node in range(size):
+            route = self.route[node]
+            for target, bits, kernel in children[node]:
+                if not kernel and node not in alive:
                     continue
-                elif expected is None:
-                    LOG_ERROR('expecting lookahead symbol')
-                    assert expected is not None
-                assert state.uuid in self.link
-                link = self.link[state.uuid]
-                assert expected.name in link
-                ns: LALRItemSet = self.state[link[expected.name]]   # next state = goto(state, next symbol)
-                # print('    ns: uuid', ns.uuid, 'kernel', [str(k) for k in ns.kernel])
-                advanced: RulePtr = rp.advance()
-                assert advanced
-                next_found = -1  # 查找当前项集内核项的产生式移进一位后与下一个项集内核项的产生式的位置
-                advanced.lookahead = None
-                # print('    advanced: ', advanced)
-                for j, nk in enumerate(ns.kernel):  # next kernel
-                    # print('nk', nk)
-                    if advanced == nk:
-                        next_found = j
-                        break
-                assert next_found >= 0
-                if rp.lookahead is None:
-                    LOG_ERROR('lookahead should not be None')
-                    assert rp.lookahead is not None
-                elif rp.lookahead == PSHARP:    # 当前内核项的产生式
-                    # 向前看符号发生传播
-                    if state.uuid not in self.route:
-                        self.route[state.uuid] = {}
-                    route = self.route[state.uuid]
-                    if key not in route:
-                        route[key] = []
-                    # 闭包中所有项都有 #, 都会向前传播到其他的项集
-                    # rout[current state][kernel production pos at current state] = [(next state, next production pos at next state) ... ]
-                    # rout[current state][kernel production pos at current state][next state] = next production pos at next state
-                    route[key].append((ns.uuid, next_found))
-                    # print('    new route: %s to %s'%(key, (ns.uuid, next_found)))
-                else:
-                    # 向前看符号自发生成
-                    # 下一项集的 lookahead 是由上一项集生成而来的
-                    ns.lookahead[next_found].add(rp.lookahead)
-        if state.uuid == 0:
-            assert len(state.kernel) > 0
-            kernel: RulePtr = state.kernel[0]
-            assert kernel.rule.head.name == 'S^'
-            state.lookahead[0].add(EOF)
-        # print()
+                # 后缀的 FIRST 自发生成
+                follow[target] |= bits & ~EPSILON_BIT
+                # 后缀能推出 epsilon, FOLLOW 从 [p, A] 传播到 [s, Xi]
+                if bits & EPSILON_BIT:
+                    route.append(target)
+        state: LALRItemSet = self.state[0]
+        assert len(state.kernel) > 0
+        assert state.kernel[0].rule.head.name == 'S^'
+        state.lookahead_bits[0] |= self.ga.term_bit(EOF.name)
         return 0
 
-    def __build_propagate_route (self):
-        for uuid in self.state:
-            state: LALRItemSet = self.state[uuid]   # 不带 lookahead 的 LR0 项集
-            state.shrink()      # 删除非内核项
-            state.dirty = True
-            self._LALR_propagate_state(state)
-            # break
+    # 扩展产生式 [uuid, rule.head] -> ...: 沿 goto 走一遍产生式右部
+    def __build_node_route (self, node, uuid, rule:Production, children):
+        nodes = self.nodes
+        link = self.link
+        state = self.state
+        reach = self.reach[node]
+        for i, name, term, bits, rp in self.__rule_walk(rule):
+            if not term:
+                target = nodes[(uuid, name)]
+                children.append((target, bits, i > 0))
+            uuid = link[uuid][name]
+            # 当前产生式移进一位后，在下一个项集内核项中的位置
+            key = state[uuid].kernel_index(rp)
+            assert key >= 0
+            reach.append((uuid, key))
         return 0
 
-    def __propagate_state (self, state:LALRItemSet) -> int:
-        changes = 0
-        # 说明该项集是最后的传播项, 不再指向下一项集。因此最后一次传播结束, 将该项集从栈弹出
-        if state.uuid not in self.route:
-            state.dirty = False
-            if state.uuid in self.dirty:
-                self.dirty.remove(state.uuid)
-            return 0
-        route = self.route[state.uuid]
-        for key, kernel in enumerate(state.kernel):
-            if key not in route:
-                continue
-            lookahead = state.lookahead[key]
-            for new_uuid, kid in route[key]:
-                # next ItemSet uuid, next production pos at next ItemSet
-                cc: LALRItemSet = self.state[new_uuid]
-                assert kid < len(cc.kernel)
-                for symbol in lookahead:
-                    # 传播 lookahead: 将当前项集的 lookahead 添加到下一项集的 lookahead
-                    if symbol not in cc.lookahead[kid]: # 下一项集的一个产生式的 lookahead 集合
-                        cc.lookahead[kid].add(symbol)
-                        cc.dirty = True
-                        self.dirty.add(cc.uuid)  # 下一项集进栈
-                        changes += 1
-        state.dirty = False
-        if state.uuid in self.dirty:
-            self.dirty.remove(state.uuid)   # 当前项集弹栈
-        return changes
-
+    # 沿产生式右部走一遍时和状态无关的部分: 每一步的符号、后缀的 FIRST
+    # 位集合以及移进后的项目。同一条产生式会从每个有该左部转移的状态出发
+    # 各走一次, 按产生式编号只算一次
+    def __rule_walk (self, rule:Production):
+        walk = self.walks.get(rule.index)
+        if walk is None:
+            suffix_first_bits = self.ga.suffix_first_bits
+            walk = []
+            rp = RulePtr.intern(rule, 0)
+            for i, symbol in enumerate(rule.body):
+                bits = 0 if symbol.term else suffix_first_bits(rule, i + 1)
+                rp = rp.advance()
+                walk.append((i, symbol.name, symbol.term, bits, rp))
+            self.walks[rule.index] = walk
+        return walk
+
+    # 传播路由是扩展非终结符之间 FOLLOW 的包含关系 (DeRemer & Pennello 的
+    # digraph): 同一个强连通分量里的 FOLLOW 互相包含, 一定相等。按分量的
+    # 拓扑序处理, 每个分量只并一次, 不用反复传播。传播结束后 FOLLOW 加到
+    # 对应的内核项上
     def __build_lookahead (self):
-        self.dirty.clear()
-        # 将所有的项集压入栈
-        for uuid in self.state:
-            self.dirty.add(uuid)
-        while 1:
-            if 0:
-                changes = 0
-                for state in self.state.values():
-                    changes += self.__propagate_state(state)
-                if changes == 0:
-                    break
-            else:
-                changes = 0
-                # list 包裹集合, for 循环时可以对集合进行修改; 直接对集合修改会报错
-                for uuid in list(self.dirty):
-                    state = self.state[uuid]
-                    changes += self.__propagate_state(state)
-                if changes == 0:
-                    break
+        follow = self.follow
+        # feeds[node]: FOLLOW 要传播到 node 的扩展非终结符
+        feeds = [[] for n in range(len(follow))]
+        for node, route in enumerate(self.route):
+            for target in route:
+                feeds[target].append(node)
+        nodes = [node for node, source in enumerate(feeds) if source]
+        for component in internal.scc(nodes, feeds.__getitem__):
+            bits = 0
+            for node in component:
+                bits |= follow[node]
+                for source in feeds[node]:
+                    bits |= follow[source]
+            for node in component:
+                follow[node] = bits
+        for node, reach in enumerate(self.reach):
+            lookahead = follow[node]
+            if not lookahead:
+                continue
+            for uuid, key in reach:
+                self.state[uuid].lookahead_bits[key] |= lookahead
         return 0
 
     def __build_LR1_state (self):
@@ -4041,9 +4890,11 @@ class LALRAnalyzer (object):
             kernel_list = []
             LOG_VERBOSE('building LR1 state', state.uuid)
             for key, kernel in enumerate(state.kernel):
-                lookahead = state.lookahead[key]
+                # 传播结束, 位集合转回向前看符号
+                lookahead = self.la._lookahead_symbols(state.lookahead_bits[key])
+                state.lookahead[key] = lookahead
                 for symbol in lookahead:
-                    rp = RulePtr(kernel.rule, kernel.index, symbol)
+                    rp = RulePtr.intern(kernel.rule, kernel.index, symbol)
                     kernel_list.append(rp)
             cc = LRItemSet(kernel_list)
             self.la.closure(cc)
@@ -4130,6 +4981,7 @@ class LL1Analyzer (object):
         return 0
 
     def __eliminate_direct_left_recursion (self, name, productions:list):
+        import copy
         left_recursive_productions = [copy.copy(production) for production in productions if production.body and production.body[0] == name]
         other_productions = [copy.copy(production) for production in productions if production not in left_recursive_productions]
 
@@ -4191,6 +5043,7 @@ class LL1Analyzer (object):
         # self.g.print()
 
     def __eliminate_backtrack (self):
+        import copy
         while 1:
             change = 0
             for head_name, productions in self.g.rule.items():
@@ -4260,79 +5113,45 @@ class LL1Analyzer (object):
 #----------------------------------------------------------------------
 class LR0Analyzer (LR1Analyzer):
 
-    def closure (self, cc:LRItemSet) -> LRItemSet:
-        cc.clear()
-        for n in cc.kernel:
-            if n.name not in cc:
-                cc.append(n)
-        if 1:
-            LOG_DEBUG('')
-            LOG_DEBUG('-' * 72)
-            LOG_DEBUG('CLOSURE init')
-        top = 0
-        while 1:
-            changes = 0
-            limit = len(cc.closure)
-            while top < limit:
-                A: RulePtr = cc.closure[top]
-                top += 1
-                B: Symbol = A.next
-                if B is None:
-                    continue
-                if B.term:
-                    continue
-                if B.name not in self.g.rule:
-                    LOG_ERROR('no production rules for symbol %s'%B.name)
-                    raise GrammarError('no production rules for symbol %s'%B.name)
-                if 1:
-                    LOG_DEBUG('CLOSURE iteration')
-                    LOG_DEBUG(f'A={A} B={B}')
-                for rule in self.g.rule[B.name]:
-                    rp = RulePtr(rule, 0)
-                    if rp.name not in cc:
-                        cc.append(rp)
-                        changes += 1
-            if changes == 0:
-                break
-        return cc
-
-    def build_table (self):
-        heading = [n for n in self.g.symbol.values()]
-        self.tab = LRTable(heading)
-        tab: LRTable = self.tab
-        # tab.mode = 1
-        if 0:
-            import pprint
-            pprint.pprint(self.link)
-        for state in self.state.values():
-            uuid = state.uuid
-            link = self.link.get(uuid, None)
-            LOG_VERBOSE(f'build table for I{state.uuid}')
-            # LOG_VERBOSE(
-            for rp in state.closure:
-                rp: RulePtr = rp
-                if rp.satisfied:
-                    LOG_VERBOSE("  satisfied:", rp)
-                    if rp.rule.head.name == 'S^':
-                        if len(rp.rule.body) == 1:
-                            action = Action(ActionName.ACCEPT, 0)
-                            action.rule = rp.rule
-                            tab.add(uuid, EOF.name, action)
-                        else:
-                            LOG_ERROR('error accept:', rp)
-                    else:
-                        action = Action(ActionName.REDUCE, rp.rule.index)
-                        action.rule = rp.rule
-                        # all terminals
-                        for terminal_name in self.g.terminal.keys():
-                            tab.add(uuid, terminal_name, action)
+    # LR(0) 项目展开不看向前看符号, 只和 B 有关
+    def _expand_item (self, A:RulePtr):
+        B: Symbol = A._next
+        if B is None or B.term:
+            return ()
+        if DEBUG:
+            LOG_DEBUG('CLOSURE iteration')
+            LOG_DEBUG(f'A={A} B={B}')
+        return self._closure_items(B.name)
+
+    # 填写状态 state 对应的一行, 表格的其他部分同 LR1Analyzer
+    def _build_row (self, tab:LRTable, state:LRItemSet):
+        uuid = state.uuid
+        link = self.link.get(uuid, None)
+        LOG_VERBOSE('build table for state', state.uuid)
+        # LOG_VERBOSE(
+        for rp in state.closure:
+            rp: RulePtr = rp
+            if rp._satisfied:
+                LOG_VERBOSE("  satisfied:", rp)
+                if rp.rule.head.name == 'S^':
+                    if len(rp.rule.body) == 1:
+                        action = tab.action(ActionName.ACCEPT, 0, rp.rule)
                         tab.add(uuid, EOF.name, action)
-                elif rp.next.name in link:
-                    target = link[rp.next.name]
-                    action = Action(ActionName.SHIFT, target, rp.rule)
-                    tab.add(uuid, rp.next.name, action)
+                    else:
+                        LOG_ERROR('error accept:', rp)
                 else:
+                    action = tab.action(ActionName.REDUCE, rp.rule.index, rp.rule)
+                    # all terminals
+                    for terminal_name in self.g.terminal.keys():
+                        tab.add(uuid, terminal_name, action)
+                    tab.add(uuid, EOF.name, action)
+            else:
+                target = link.get(rp._next_name)
+                if target is None:
                     LOG_ERROR('error link')
+                    continue
+                action = tab.action(ActionName.SHIFT, target, rp.rule)
+                tab.add(uuid, rp._next_name, action)
         return 0
 
 #----------------------------------------------------------------------
@@ -4340,42 +5159,34 @@ class LR0Analyzer (LR1Analyzer):
 #----------------------------------------------------------------------
 class SLRAnalyzer (LR0Analyzer):
 
-    def build_table (self):
-        heading = [n for n in self.g.symbol.values()]
-        self.tab = LRTable(heading)
-        tab: LRTable = self.tab
-        # tab.mode = 1
-        if 0:
-            import pprint
-            pprint.pprint(self.link)
-        for state in self.state.values():
-            uuid = state.uuid
-            link = self.link.get(uuid, None)
-            LOG_VERBOSE(f'build table for I{state.uuid}')
-            # LOG_VERBOSE(
-            for rp in state.closure:
-                rp: RulePtr = rp
-                if rp.satisfied:
-                    LOG_VERBOSE("  satisfied:", rp)
-                    if rp.rule.head.name == 'S^':
-                        if len(rp.rule.body) == 1:
-                            action = Action(ActionName.ACCEPT, 0)
-                            action.rule = rp.rule
-                            tab.add(uuid, EOF.name, action)
-                        else:
-                            LOG_ERROR('error accept:', rp)
+    # 填写状态 state 对应的一行, 表格的其他部分同 LR1Analyzer
+    def _build_row (self, tab:LRTable, state:LRItemSet):
+        uuid = state.uuid
+        link = self.link.get(uuid, None)
+        LOG_VERBOSE('build table for state', state.uuid)
+        # LOG_VERBOSE(
+        for rp in state.closure:
+            rp: RulePtr = rp
+            if rp._satisfied:
+                LOG_VERBOSE("  satisfied:", rp)
+                if rp.rule.head.name == 'S^':
+                    if len(rp.rule.body) == 1:
+                        action = tab.action(ActionName.ACCEPT, 0, rp.rule)
+                        tab.add(uuid, EOF.name, action)
                     else:
-                        action = Action(ActionName.REDUCE, rp.rule.index)
-                        action.rule = rp.rule
-                        # follow(head.name)
-                        for symbol_name in self.ga.FOLLOW[rp.rule.head.name]:
-                            tab.add(uuid, symbol_name, action)
-                elif rp.next.name in link:
-                    target = link[rp.next.name]
-                    action = Action(ActionName.SHIFT, target, rp.rule)
-                    tab.add(uuid, rp.next.name, action)
+                        LOG_ERROR('error accept:', rp)
                 else:
+                    action = tab.action(ActionName.REDUCE, rp.rule.index, rp.rule)
+                    # follow(head.name)
+                    for symbol_name in self.ga.FOLLOW[rp.rule.head.name]:
+                        tab.add(uuid, symbol_name, action)
+            else:
+                target = link.get(rp._next_name)
+                if target is None:
                     LOG_ERROR('error link')
+                    continue
+                action = tab.action(ActionName.SHIFT, target, rp.rule)
+                tab.add(uuid, rp._next_name, action)
         return 0
 
 #----------------------------------------------------------------------
@@ -4422,16 +5233,31 @@ class ConflictSolver (object):
 
     def process (self):
         tab: LRTable = self.tab
-        self.state = -1
-        for row in tab.rows:
-            self.state += 1
-            for key in list(row.keys()):
-                cell = row[key]
-                if not cell:
-                    continue
-                if len(cell) <= 1:
-                    continue
-                self._solve_conflict(cell)
+        if isinstance(tab.rows, LRLazyRows):
+            # 按需展开的表: 已经展开的行现在解决, 其他行展开时再解决
+            for state, row in tab.rows.expanded():
+                self.process_row(state, row)
+            tab.rows.solve = self.process_row
+            return 0
+        for state, row in enumerate(tab.rows):
+            self.process_row(state, row)
+        return 0
+
+    def process_row (self, state, row):
+        tab: LRTable = self.tab
+        self.state = state
+        for key in list(row.keys()):
+            cell = row[key]
+            if not cell:
+                continue
+            if isinstance(cell, Action):
+                continue
+            if len(cell) <= 1:
+                continue
+            self._solve_conflict(cell)
+            # 冲突解决后只剩一个动作, 还原成单个 Action
+            if tab.mode == 0 and len(cell) == 1:
+                row[key] = cell.pop()
         return 0
 
     def _solve_conflict (self, actionset):
@@ -4450,7 +5276,7 @@ class ConflictSolver (object):
             actionset.add(final)
         elif isinstance(actionset, list):
             actionset.clear()
-            actionset.push(final)
+            actionset.append(final)
         return 0
 
     def warning_conflict (self, action1:Action, action2:Action):
@@ -4538,15 +5364,18 @@ class Lexer (object):
         self.actions = {}
         self.require = {}
         self.intercept_literal = True
+        self._compiled = None
 
     def clear (self):
         self.rules.clear()
         self.literal.clear()
         self.require.clear()
+        self._compiled = None
         return 0
 
     def push_skip (self, pattern:str):
         self.rules.append((None, pattern))
+        self._compiled = None
         return 0
 
     def _is_action (self, name:str) -> bool:
@@ -4560,6 +5389,7 @@ class Lexer (object):
             self.rules.append((self.__handle_action, pattern, action))
         else:
             self.rules.append((name, pattern))
+        self._compiled = None
         return 0
 
     def push_import_match (self, name:str, key:str):
@@ -4579,6 +5409,7 @@ class Lexer (object):
 
     def push_literal (self, literal:str):
         self.literal[literal] = cstring.string_quote(literal)
+        self._compiled = None
 
     def __handle_action (self, text:str, action:str):
         if text in self.literal:
@@ -4611,16 +5442,24 @@ class Lexer (object):
         t = Token(self.literal[name], name, token.line, token.column)
         return t
 
+    # 规则和合并后的正则只构建一次，push_* 之后失效
+    def __compile (self):
+        if self._compiled is None:
+            rules = [n for n in self.rules]
+            for literal in self.literal:
+                escape = re.escape(literal)
+                rules.append((self.__handle_literal, escape))
+            rules.append((self.__handle_mismatch, '.'))
+            regex = _compile_specs(tuple([n[1] for n in rules]))
+            self._compiled = (rules, regex)
+        return self._compiled
+
     def tokenize (self, code) -> Generator[Token, None, None]:
-        rules = [n for n in self.rules]
-        for literal in self.literal:
-            escape = re.escape(literal)
-            rules.append((self.__handle_literal, escape))
-        rules.append((self.__handle_mismatch, '.'))
+        rules, regex = self.__compile()
         last_line = 1
         last_column = 1
         try:
-            for token in tokenize(code, rules, '$'):
+            for token in tokenize(code, rules, '$', regex):
                 last_line = token.line
                 last_column = token.column
                 if isinstance(token.value, str):
@@ -4829,8 +5668,11 @@ class PDA (object):
             self.error = 'unexpected token: %r'%lookahead
             self.error_token(lookahead, self.error)
             return -5
-        assert len(data) == 1   # if len(data) > 1, maybe happen to conflict (shift and reduce conflict)
-        action: Action = list(data)[0]
+        if isinstance(data, Action):
+            action: Action = data
+        else:
+            assert len(data) == 1   # if len(data) > 1, maybe happen to conflict (shift and reduce conflict)
+            action: Action = list(data)[0]
         if not action:
             self.error = 'invalid action'
             self.error_token(lookahead, 'invalid action:', str(action))
@@ -4909,9 +5751,11 @@ class PDA (object):
             raise ValueError('stack size is not enough')
         value = None
         executed = 0
-        action_dict = rule.action and rule.action or {}
-        for pos, actions in action_dict.items():
-            if pos != size:
+        action_list = rule.action and rule.action or []
+        for pos, actions in enumerate(action_list):
+            if not actions:
+                continue
+            elif pos != size:
                 LOG_ERROR('invalid action pos: %d'%pos)
                 continue
             for action in actions:
@@ -4956,7 +5800,10 @@ class PDA (object):
             self.error = 'reduction state mismatch'
             self.error_token(self.current, self.error)
             return -11
-        action: Action = list(data)[0]
+        if isinstance(data, Action):
+            action: Action = data
+        else:
+            action: Action = list(data)[0]
         if not action:
             self.error = 'invalid action: %s'%str(action)
             self.error_token(self.current, self.error)
@@ -5044,8 +5891,28 @@ class Parser (object):
 #----------------------------------------------------------------------
 # create parser with grammar
 #----------------------------------------------------------------------
+# 本文件源代码的摘要: 生成器的代码改了, 以前缓存的表就不能再用
+@functools.lru_cache(maxsize = None)
+def _source_digest():
+    try:
+        with open(__file__, 'rb') as fp:
+            return hashlib.sha1(fp.read()).hexdigest()
+    except (OSError, NameError):
+        return ''
+
+def __load_cached_table(g:Grammar, cache_path, fingerprint):
+    data = LRTable.load(cache_path, fingerprint)
+    if data is None:
+        return None
+    # 和分析器 process() 里一样处理文法, 产生式编号才能和缓存的表对上
+    GrammarAnalyzer(g).process()
+    if 'S^' not in g.symbol:
+        g.augment()
+    return LRTable.restore(g, data)
+
 def __create_with_grammar(g:Grammar, semantic_action, 
-                          lexer_action, algorithm):
+                          lexer_action, algorithm, lazy = False,
+                          cache_path = None):
     if g is None:
         return None
     if algorithm.lower() in ('lr1', 'lr(1)'):
@@ -5058,6 +5925,21 @@ def __create_with_grammar(g:Grammar, semantic_action,
         algorithm = 'slr'
     else:
         algorithm = 'lr1'
+    if cache_path:
+        # 指纹在文法展开语义动作和增广之前计算, 两条路径上都一样,
+        # 里面包括表格格式版本和生成器代码的摘要
+        fingerprint = '%d:%s:%s:%s'%(LRTable.VERSION, _source_digest(),
+                                     algorithm, g.fingerprint())
+        tab = __load_cached_table(g, cache_path, fingerprint)
+        if tab is not None:
+            parser = Parser(g, tab)
+            if semantic_action:
+                parser.pda.install_semantic_action(semantic_action)
+            if lexer_action:
+                parser.pda.install_lexer_action(lexer_action)
+            return parser
+        # 要存盘的表必须完整, 不能按需展开
+        lazy = False
     if algorithm == 'lr1':
         analyzer = LR1Analyzer(g)
     elif algorithm == 'lr0':
@@ -5066,12 +5948,21 @@ def __create_with_grammar(g:Grammar, semantic_action,
         analyzer = SLRAnalyzer(g)
     else:
         analyzer = LALRAnalyzer(g)
-    hr = analyzer.process()
+    if lazy and algorithm != 'lalr':
+        # LALR 传播向前看符号需要全部 LR(0) 状态, 不能按需展开
+        hr = analyzer.process(lazy = True)
+    else:
+        hr = analyzer.process()
     if hr != 0:
         return None
     tab:LRTable = analyzer.tab
     cs:ConflictSolver = ConflictSolver(g, tab)
     cs.process()
+    if cache_path:
+        try:
+            tab.save(cache_path, fingerprint)
+        except OSError as e:
+            LOG_WARNING('cannot save table to %s: %s'%(cache_path, e))
     parser = Parser(g, tab)
     if semantic_action:
         parser.pda.install_semantic_action(semantic_action)
@@ -5086,9 +5977,12 @@ def __create_with_grammar(g:Grammar, semantic_action,
 def create_parser(grammar_bnf: str, 
                   semantic_action = None,
                   lexer_action = None,
-                  algorithm = 'lr1'):
+                  algorithm = 'lr1',
+                  lazy = False,
+                  cache_path = None):
     g = load_from_string(grammar_bnf)
-    return __create_with_grammar(g, semantic_action, lexer_action, algorithm)
+    return __create_with_grammar(g, semantic_action, lexer_action, algorithm,
+                                 lazy, cache_path)
 
 
 #----------------------------------------------------------------------
@@ -5097,9 +5991,12 @@ def create_parser(grammar_bnf: str,
 def create_parser_from_file(grammar_file_name: str,
                             semantic_action = None,
                             lexer_action = None,
-                            algorithm = 'lr1'):
+                            algorithm = 'lr1',
+                            lazy = False,
+                            cache_path = None):
     g = load_from_file(grammar_file_name)
-    return __create_with_grammar(g, semantic_action, lexer_action, algorithm)
+    return __create_with_grammar(g, semantic_action, lexer_action, algorithm,
+                                 lazy, cache_path)
 
 
 #----------------------------------------------------------------------
@@ -5127,6 +6024,7 @@ if __name__ == '__main__':
         la.process()
         for cc in la.state.values():
             cc.print()
+        import pprint
         pprint.pprint(la.link)
         print()
         pprint.pprint(la.route)
@@ -5299,4 +6197,75 @@ if __name__ == '__main__':
                                algorithm = 'lr1')
         print(parser('011.101', debug=True))
 
-    test11()
\ No newline at end of file
+    def test12():
+        # 增量 update() 要和从头构造的文法结果一样
+        def dump(g):
+            symbol = [(n, s.term) for n, s in g.symbol.items()]
+            rule = [(n, [str(p) for p in v]) for n, v in g.rule.items()]
+            return symbol, rule, [p.index for p in g.production]
+        def rebuild(g):
+            obj = Grammar()
+            for t in g.terminal:
+                obj.push_token(t)
+            for n in g.precedence:
+                obj.push_precedence(n, g.precedence[n], g.assoc[n])
+            for p in g.production:
+                obj.append(Production(p.head.name, [n.name for n in p.body]))
+            obj.update()
+            return obj
+        g = load_from_string('''
+        E: E '+' T | T;
+        T: n;
+        ''')
+        steps = [
+            lambda: g.append(Production('T', ['(', 'E', ')'])),
+            lambda: g.append(Production('F', ['m'])),
+            lambda: g.insert(1, Production('E', ['E', "'-'", 'T'])),
+            lambda: g.replace(0, Production('E', ['E', "'*'", 'T'])),
+            lambda: g.production.__setitem__(2, Production('T', ['x'])),
+            lambda: g.production.reverse(),
+            lambda: g.append(Production('G', ['E'])),
+            lambda: g.push_token('m'),
+            lambda: g.push_precedence("'*'", 1, 'left'),
+            lambda: g.append(Production('T', ['T', "'*'", 'F'])),
+            lambda: g.pop(),
+        ]
+        for i, step in enumerate(steps):
+            step()
+            g.update()
+            assert dump(g) == dump(rebuild(g)), 'step %d'%i
+        print('ok')
+        return 0
+
+    def test13():
+        # 缓存文件只能是字面量, 其他内容一律当成无效, 重新生成分析表
+        import tempfile
+        grammar_definition = r'''
+        E: E '+' T | T;
+        T: T '*' F | F;
+        F: number | '(' E ')';
+        %token number
+        @ignore [ \t\n]*
+        @match number \d+
+        '''
+        fd, cache = tempfile.mkstemp(suffix = '.tab')
+        os.close(fd)
+        try:
+            with open(cache, 'w') as fp:
+                fp.write("__import__('os').getpid()")
+            assert LRTable.load(cache, '') is None
+            parser = create_parser(grammar_definition, algorithm = 'lalr',
+                                   cache_path = cache)
+            assert parser is not None
+            with open(cache, 'r') as fp:
+                assert fp.read().startswith('{')
+            again = create_parser(grammar_definition, algorithm = 'lalr',
+                                  cache_path = cache)
+            assert parser.tab.rows == again.tab.rows
+            assert again('1*(2+3)') is not None
+        finally:
+            os.remove(cache)
+        print('ok')
+        return 0
+
+    test13()
\ No newline at end of file